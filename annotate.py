@@ -0,0 +1,96 @@
+import numpy as np
+import functools
+import platform
+from PIL import Image, ImageDraw, ImageFont, ImageColor
+
+'''
+annotations drawn straight into RGB numpy images. Fonts are loaded once, characters are rendered
+once per font size into alpha masks and only blended into the image per frame.
+'''
+
+@functools.lru_cache(maxsize=None)
+def load_font(fontsize=15):
+    'the truetype font of the platform in <fontsize>, loaded only once'
+    # check that the font is actually available!
+    fonttype = 'arial.ttf' if platform.system() == 'Windows' else 'DejaVuSans.ttf'
+    try:
+        return ImageFont.truetype(fonttype, fontsize)
+    except OSError:
+        return ImageFont.load_default()
+
+@functools.lru_cache(maxsize=None)
+def rgb_color(color):
+    'PIL color name or tuple to an RGB uint8 array'
+    return np.array(ImageColor.getrgb(color)[:3] if isinstance(color,str) else color[:3],dtype=np.uint8)
+
+@functools.lru_cache(maxsize=None)
+def dot_mask(dotsize=4):
+    'alpha mask of a filled circle with the diameter <dotsize>'
+    s = dotsize/2
+    r = int(np.ceil(s))
+    y,x = np.mgrid[-r:r+1,-r:r+1]
+    return np.uint8(x**2 + y**2 <= (s+0.5)**2) * 255
+
+
+class glyphs:
+
+    def __init__(self,fontsize=15) -> None:
+        'alpha masks of single characters, each character is rendered only once'
+        self.font = load_font(fontsize)
+        self.fontsize = fontsize
+        ascent,descent = self.font.getmetrics()
+        self.height = ascent + descent
+        self.chars = {}
+
+    def char(self,ch):
+        if ch not in self.chars :
+            w = max(int(np.ceil(self.font.getlength(ch))),1)
+            im = Image.new('L',(w,self.height))
+            ImageDraw.Draw(im).text((0,0),ch,fill=255,font=self.font)
+            self.chars[ch] = np.asarray(im)
+        return self.chars[ch]
+
+    def text(self,text):
+        'alpha mask of a whole label, the most recent labels are kept'
+        return _label(self.fontsize,text)
+
+
+@functools.lru_cache(maxsize=64)
+def _label(fontsize,text):
+    'label mask cache of all font sizes, the font only depends on the size (load_font)'
+    g = get_glyphs(fontsize)
+    return np.hstack([g.char(ch) for ch in text]) if text else np.zeros((g.height,0),dtype=np.uint8)
+
+
+@functools.lru_cache(maxsize=None)
+def get_glyphs(fontsize=15)->glyphs:
+    'the shared glyph cache for <fontsize>'
+    return glyphs(fontsize)
+
+
+def blend(rgb,mask,x,y,color):
+    'blends <color> with the alpha <mask> into <rgb> at the top left position (x,y), clipped at the borders'
+    h,w = rgb.shape[:2]
+    mh,mw = mask.shape
+    x0,y0 = max(x,0),max(y,0)
+    x1,y1 = min(x+mw,w),min(y+mh,h)
+    if x1 <= x0 or y1 <= y0 : return
+    region = rgb[y0:y1,x0:x1]
+    a = mask[y0-y:y1-y,x0-x:x1-x,None].astype(np.int32) # int16 overflows at 255*255
+    region[:] = region + (rgb_color(color).astype(np.int32) - region) * a // 255
+
+
+def draw_annotation(rgb,pos,text,color='red',fontsize=15,dotsize=4):
+    '''numpy RGB image - draws a circle at the <pos> location and the annotation <text> next to it.
+    Checks for image borders and adjusts the text position so the text remains visible
+    '''
+    dot = dot_mask(dotsize)
+    r = dot.shape[0]//2
+    blend(rgb,dot,int(pos[0])-r,int(pos[1])-r,color)
+    mask = get_glyphs(fontsize).text(text)
+    tl = mask.shape[1]
+    h,w = rgb.shape[:2]
+    # give some offset if text is near the border:
+    x = pos[0] - tl if abs(pos[0]-dotsize/2) + tl > w else pos[0]
+    y = pos[1] - fontsize if abs(pos[1]-dotsize/2) + fontsize > h else pos[1]
+    blend(rgb,mask,int(x),int(y),color)
@@ -0,0 +1,336 @@
+import numpy as np
+import cv2
+import time
+import json
+import io
+import sys
+import argparse
+import platform
+import tracemalloc
+from PIL import Image
+
+from p2pro import p2pro,raw_to_temperature,tempconverter
+from replay import syntheticcam,make_frame
+from colormap import colormapper,colorbar
+from history import history
+from pipeline import pipeline
+import annotate
+from extras import frame_stats,find_tmin,find_tmax,rotate,draw_annotation,colorbarfig,p2pro_cmd
+
+'''
+headless benchmark of the acquisition to display path on synthetic frames.
+
+python benchmark.py                          run all cases
+python benchmark.py -k color                 only cases containing 'color'
+python benchmark.py --save baseline.json     store the results as baseline
+python benchmark.py --compare baseline.json  show the change against a baseline, exit code 1 on regressions
+'''
+
+cases = {} # name -> setup function that returns the callable to time
+
+
+def case(name):
+    def register(setup):
+        cases[name] = setup
+        return setup
+    return register
+
+
+class frozencam(p2pro):
+
+    def __init__(self) -> None:
+        'replays one synthetic frame without pacing, _read() returns a new array like cv2 does'
+        self.frame = make_frame(raw_frame())
+        self._setup()
+
+    def _read(self):
+        return self.frame.copy()
+
+    def release(self):
+        self.stop()
+
+
+def raw_frame(n=0):
+    cam = syntheticcam('fast')
+    return np.clip((cam.scene(n) + 273.2) * 64,0,65535).astype(np.uint16)
+
+
+@case('decode get_frame+frames')
+def _():
+    cam = frozencam()
+    return cam.frames
+
+@case('decode legacy raw (intc)')
+def _():
+    cam = frozencam()
+    def legacy():
+        frame = cam.get_frame()
+        raw = frame[1,:,:,:].astype(np.intc)
+        return (raw[:,:,1] << 8) + raw[:,:,0]
+    return legacy
+
+@case('temperature lut')
+def _():
+    raw = raw_frame()
+    return lambda : raw_to_temperature(raw)
+
+@case('temperature lut reused buffers')
+def _():
+    raw = raw_frame()
+    conv = tempconverter()
+    return lambda : conv(raw)
+
+@case('temperature legacy float64')
+def _():
+    raw = raw_frame().astype(np.intc)
+    return lambda : raw/64 - 273.2
+
+@case('stats frame_stats')
+def _():
+    temp = raw_to_temperature(raw_frame())
+    return lambda : frame_stats(temp)
+
+@case('stats legacy find_tmin/find_tmax')
+def _():
+    temp = raw_to_temperature(raw_frame())
+    return lambda : (find_tmin(temp),find_tmax(temp),temp.min(),temp.max(),temp.mean())
+
+@case('rotate 90 + copy')
+def _():
+    temp = raw_to_temperature(raw_frame())
+    return lambda : np.ascontiguousarray(rotate(temp,90))
+
+@case('blur 3x3')
+def _():
+    temp = raw_to_temperature(raw_frame())
+    return lambda : cv2.blur(temp,(3,3))
+
+@case('sharpen filter2D')
+def _():
+    temp = raw_to_temperature(raw_frame())
+    kernel = np.array([[0, -1, 0], [-1, 5, -1], [0, -1, 0]])
+    return lambda : cv2.filter2D(temp,-1,kernel)
+
+@case('colormap lut')
+def _():
+    temp = raw_to_temperature(raw_frame())
+    cm = colormapper('jet')
+    return lambda : cm.apply(temp,20.,60.)
+
+@case('colormap legacy matplotlib')
+def _():
+    import matplotlib.pyplot as plt
+    temp = raw_to_temperature(raw_frame())
+    cm = plt.get_cmap('jet')
+    return lambda : np.uint8(cm((temp-20.)/40.) * 255)
+
+@case('draw_annotation x3')
+def _():
+    im = Image.fromarray(colormapper('jet').apply(raw_to_temperature(raw_frame()),20.,60.))
+    def draw():
+        draw_annotation(im,(200,100),'65.00C')
+        draw_annotation(im,(10,10),'21.60C',color='lightblue')
+        draw_annotation(im,(128,96),'40.00C',color='lightblue')
+    return draw
+
+@case('annotate x3 numpy')
+def _():
+    rgb = colormapper('jet').apply(raw_to_temperature(raw_frame()),20.,60.)
+    def draw():
+        annotate.draw_annotation(rgb,(200,100),'65.00C')
+        annotate.draw_annotation(rgb,(10,10),'21.60C',color='lightblue')
+        annotate.draw_annotation(rgb,(128,96),'40.00C',color='lightblue')
+    return draw
+
+@case('colorbarfig + png')
+def _():
+    def render():
+        f = colorbarfig(20.,60.,'jet')
+        f.savefig(io.BytesIO(),format='png')
+    return render
+
+@case('colorbar numpy redraw')
+def _():
+    cb = colorbar()
+    vmax = [60.]
+    def render():
+        vmax[0] += 0.5 # forces a redraw every call
+        cb.render('jet',20.,vmax[0])
+    return render
+
+@case('history add')
+def _():
+    h = history(maxitems=10000,columns=4,reduce=('min','max','mean','minmax'))
+    return lambda : h.add((20.,60.,40.,41.))
+
+@case('history timerange 500s')
+def _():
+    h = full_history()
+    return lambda : h.timerange(500,0,max_samples=1024)
+
+@case('history csv')
+def _():
+    h = full_history()
+    return h.csv
+
+def full_history():
+    'a full history with a 10 Hz time axis from its own clock'
+    tick = [0.]
+    h = history(maxitems=10000,columns=4,reduce=('min','max','mean','minmax'),clock=lambda : tick[0])
+    for k in range(10000):
+        tick[0] = k*0.1
+        h.add((20.,60.+np.sin(k/50),40.,41.))
+    return h
+
+@case('end to end frame')
+def _():
+    cam = frozencam()
+    h = history(maxitems=10000,columns=4,reduce=('min','max','mean','minmax'))
+    cm = colormapper('jet')
+    def frame():
+        raw,video = cam.frames()
+        raw = rotate(raw,90)
+        temp = raw_to_temperature(raw)
+        stat = frame_stats(temp)
+        h.add(stat[:4])
+        temp = cv2.blur(temp,(3,3))
+        rgb = cm.apply(temp,stat.min,stat.max)
+        annotate.draw_annotation(rgb,stat.argmax,f'{stat.max:1.2f}C')
+        annotate.draw_annotation(rgb,stat.argmin,f'{stat.min:1.2f}C',color='lightblue')
+        im = Image.fromarray(rgb)
+        im.save(io.BytesIO(),format='png') # streamlit sends PIL images as png
+    return frame
+
+@case('pipeline rot+blur+annotate none')
+def _():
+    return pipeline_case('none')
+
+@case('pipeline rot+blur+annotate jpeg')
+def _():
+    return pipeline_case('jpeg')
+
+@case('pipeline rot+blur+annotate png')
+def _():
+    return pipeline_case('png')
+
+def pipeline_case(encoding):
+    temp = raw_to_temperature(raw_frame())
+    stat = frame_stats(temp)
+    pipe = pipeline('jet',rotate=90,sharp=-2,annotations=True,encoding=encoding)
+    return lambda : pipe(temp,stat.min,stat.max,stat)
+
+SIM_USB = dict(latency=0.0002,busy=0.001) # rough model of a control transfer and of the command processing, not measured
+
+@case('usb cmd tpd write (sim)')
+def _():
+    m = p2pro_cmd()
+    cam = m.P2Pro(m.SimDevice(**SIM_USB))
+    return lambda : cam.set_prop_tpd_params(m.PropTpdParams.TPD_PROP_EMS,120)
+
+@case('usb cmd tpd read (sim)')
+def _():
+    m = p2pro_cmd()
+    cam = m.P2Pro(m.SimDevice(**SIM_USB))
+    return lambda : cam.get_prop_tpd_params(m.PropTpdParams.TPD_PROP_EMS)
+
+@case('usb cmd device info 50 bytes (sim)')
+def _():
+    m = p2pro_cmd()
+    cam = m.P2Pro(m.SimDevice(**SIM_USB))
+    return lambda : cam.get_device_info(m.DeviceInfoType.DEV_INFO_FW_BUILD_VERSION_INFO)
+
+@case('usb cmd 1 kB chunked write (sim)')
+def _():
+    m = p2pro_cmd()
+    cam = m.P2Pro(m.SimDevice(**SIM_USB))
+    data = bytes(range(256)) * 4
+    return lambda : cam._standard_cmd_write(m.CmdCode.spi_transfer | m.CmdDir.SET,0,data)
+
+@case('usb cmd 6 tpd params direct (sim)')
+def _():
+    m = p2pro_cmd()
+    cam = m.P2Pro(m.SimDevice(**SIM_USB))
+    def writes():
+        for p in m.PropTpdParams : cam.set_prop_tpd_params(p,1)
+    return writes
+
+@case('usb cmd 6 tpd params worker (sim)')
+def _(): # the same six usb writes, queued as one batch without waiting in between
+    m = p2pro_cmd()
+    worker = m.CmdWorker(m.P2Pro(m.SimDevice(**SIM_USB)))
+    def writes():
+        for p in m.PropTpdParams : fut = worker.set_prop_tpd_params(p,1)
+        fut.result()
+    return writes
+
+@case('usb cmd 6 same param merged (sim)')
+def _(): # a slider drag: the queued writes of the same parameter are merged, only the last value is sent
+    m = p2pro_cmd()
+    worker = m.CmdWorker(m.P2Pro(m.SimDevice(**SIM_USB)))
+    def writes():
+        for k in range(6): fut = worker.set_prop_tpd_params(m.PropTpdParams.TPD_PROP_EMS,115 + k)
+        fut.result()
+    return writes
+
+
+def measure(fn,frames,warmup=5):
+    'latency statistics in ms and the allocated memory per call in kB'
+    for _ in range(warmup): fn()
+    lat = np.empty(frames)
+    for k in range(frames):
+        t0 = time.perf_counter()
+        fn()
+        lat[k] = time.perf_counter() - t0
+    lat *= 1000
+    tracemalloc.start()
+    n = min(frames,20)
+    alloc = 0
+    for _ in range(n):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        fn()
+        alloc += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    p50,p95,p99 = np.percentile(lat,(50,95,99))
+    return dict(calls_per_s=1000/lat.mean(),mean_ms=lat.mean(),p50_ms=p50,p95_ms=p95,p99_ms=p99,alloc_kb=alloc/n/1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark of the p2pro live display path')
+    parser.add_argument('-k',default='',help='only run cases whose name contains this text')
+    parser.add_argument('--frames',type=int,default=200,help='timed calls per case')
+    parser.add_argument('--save',help='write the results as json baseline file')
+    parser.add_argument('--compare',help='json baseline file to compare against')
+    parser.add_argument('--threshold',type=float,default=20.,help='regression threshold in %% of p50')
+    args = parser.parse_args()
+
+    base = {}
+    if args.compare :
+        with open(args.compare) as f : base = json.load(f)['results']
+    results = {}
+    regressions = []
+    print(f"{'case':36} {'calls/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'alloc kB':>9}  change")
+    for name,setup in cases.items():
+        if args.k not in name : continue
+        r = measure(setup(),args.frames)
+        results[name] = r
+        change = ''
+        if name in base :
+            d = (r['p50_ms']/base[name]['p50_ms'] - 1)*100
+            change = f'{d:+6.1f}%'
+            if d > args.threshold :
+                change += ' REGRESSION'
+                regressions.append(name)
+        print(f"{name:36} {r['calls_per_s']:9.1f} {r['p50_ms']:8.3f} {r['p95_ms']:8.3f} {r['p99_ms']:8.3f} {r['alloc_kb']:9.1f}  {change}")
+
+    if args.save :
+        info = dict(python=platform.python_version(),numpy=np.__version__,opencv=cv2.__version__,
+                    machine=platform.machine(),system=platform.system(),date=time.strftime('%Y-%m-%d %H:%M:%S'))
+        with open(args.save,'w') as f : json.dump(dict(info=info,results=results),f,indent=1)
+    if regressions :
+        print(f'{len(regressions)} regression(s) above {args.threshold}%')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
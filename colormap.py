@@ -0,0 +1,114 @@
+import numpy as np
+import cv2
+import functools
+
+# https://matplotlib.org/stable/gallery/color/colormap_reference.html
+cmaplist = ['jet','gray','bone', 'cividis','rainbow','terrain','nipy_spectral','gist_ncar','brg','hot','plasma', 'viridis','inferno', 'magma','afmhot','tab20c']
+
+
+@functools.lru_cache(maxsize=None)
+def colormap_lut(name,levels=256):
+    '''returns the cached, read only uint8 RGB table of shape (256,1,3) sampled with <levels> (2..256)
+       colors from the matplotlib colormap <name>. Entries above levels-1 repeat the last color'''
+    from matplotlib import colormaps
+    assert 2 <= levels <= 256, f'levels must be in 2..256, got {levels}'
+    rgb = colormaps[name](np.linspace(0,1,levels))[:,:3]
+    lut = np.empty((256,1,3),dtype=np.uint8)
+    lut[:levels,0] = np.uint8(rgb * 255) # same rounding as the old float path
+    lut[levels:,0] = lut[levels-1,0]
+    lut.flags.writeable = False
+    return lut
+
+
+def raw_range(tmin,tmax):
+    'converts a temperature range in Celsius to raw 16bit sensor units'
+    return (tmin + 273.2) * 64, (tmax + 273.2) * 64
+
+
+class colormapper:
+
+    def __init__(self,name='jet',levels=256) -> None:
+        '''maps images to uint8 RGB by a table lookup with an 8bit index.
+           The work buffers are allocated once per image shape and the
+           returned image is reused by the next call!'''
+        self.set_colormap(name,levels)
+        self.shape = None
+
+    def set_colormap(self,name,levels=256):
+        self.name = name
+        self.levels = levels
+        self.lut = colormap_lut(name,levels)
+
+    def _buffers(self,shape):
+        if self.shape != shape :
+            self.shape = shape
+            self.fbuf = np.empty(shape,dtype=np.float32)
+            self.index = np.empty(shape,dtype=np.uint8)
+            self.rgb = np.empty(shape+(3,),dtype=np.uint8)
+
+    def apply(self,img,vmin,vmax,out=None):
+        '''colorize <img> with <vmin> mapped to the first and <vmax> to the last color,
+           values outside are clipped. <img> may be a temperature or a raw image'''
+        self._buffers(img.shape)
+        scale = self.levels/(vmax-vmin) if vmax > vmin else 0.
+        np.subtract(img,vmin,out=self.fbuf,dtype=np.float32)
+        np.maximum(self.fbuf,0,out=self.fbuf)
+        # scale, round down and saturate at 255 in one pass:
+        cv2.convertScaleAbs(self.fbuf,self.index,scale,-0.5)
+        if out is None : out = self.rgb
+        return cv2.applyColorMap(self.index,self.lut,dst=out)
+
+    def apply_raw(self,raw,tmin,tmax,out=None):
+        'colorize the raw 16bit image directly, <tmin>,<tmax> are in Celsius'
+        return self.apply(raw,*raw_range(tmin,tmax),out=out)
+
+
+def nice_ticks(vmin,vmax,n=6):
+    'about <n> round tick values (steps of 1,2,5 times a power of 10) between <vmin> and <vmax>'
+    if vmax <= vmin : return np.array([vmin])
+    raw = (vmax-vmin)/n
+    mag = 10**np.floor(np.log10(raw))
+    step = mag * min((1,2,5,10),key=lambda m : abs(m*mag - raw))
+    return np.arange(np.ceil(vmin/step),np.floor(vmax/step)+1) * step + 0. # no -0
+
+
+class colorbar:
+
+    def __init__(self,height=384,width=24,fontsize=14,quantum=0.1) -> None:
+        '''renders a vertical colorbar with tick labels as numpy RGB image from the colormap table.
+           The last image is reused as long as the range rounded to <quantum> does not change'''
+        self.height = height
+        self.width = width
+        self.fontsize = fontsize
+        self.quantum = quantum
+        self.key = None
+        self.image = None
+
+    def render(self,cmapname,vmin,vmax):
+        'returns the colorbar image, the same object as before if nothing visible changed'
+        q = self.quantum
+        key = (cmapname,round(vmin/q),round(vmax/q))
+        if key != self.key :
+            self.key = key
+            self.image = self._draw(cmapname,key[1]*q,key[2]*q)
+        return self.image
+
+    def _draw(self,cmapname,vmin,vmax):
+        from annotate import get_glyphs,blend
+        glyphs = get_glyphs(self.fontsize)
+        h,pad = self.height,glyphs.height//2 # room for the labels at both ends
+        ticks = nice_ticks(vmin,vmax)
+        step = ticks[1]-ticks[0] if len(ticks) > 1 else 1.
+        digits = max(0,-int(np.floor(np.log10(step)))) if step > 0 else 0
+        labels = [f'{t:.{digits}f}' for t in ticks]
+        tw = max(glyphs.text(s).shape[1] for s in labels)
+        img = np.full((h+2*pad,self.width+6+tw+2,3),255,dtype=np.uint8)
+        # gradient, maximum at the top
+        index = np.linspace(255,0,h).astype(np.uint8)
+        img[pad:pad+h,:self.width] = colormap_lut(cmapname)[index]
+        img[pad:pad+h,self.width] = 0 # frame line
+        for t,s in zip(ticks,labels):
+            y = pad + int(round((vmax-t)/(vmax-vmin)*(h-1))) if vmax > vmin else pad + h//2
+            img[y,self.width:self.width+4] = 0 # tick mark
+            blend(img,glyphs.text(s),self.width+6,y-glyphs.height//2,'black')
+        return img
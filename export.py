@@ -0,0 +1,54 @@
+import numpy as np
+import io
+import zipfile
+
+'''
+export of history data and images as chunked csv or compact binary data
+'''
+
+def format_block(block,fmt='%1.2f',delimiter=' ')->str:
+    'formats the 2D array <block> as csv text with one single string formatting operation'
+    n,cols = block.shape
+    row = delimiter.join([fmt]*cols) + '\n'
+    return (row*n) % tuple(block.ravel().tolist())
+
+def iter_csv(blocks,fmt='%1.2f',delimiter=' '):
+    'generator of csv text chunks, one per 2D array from the iterable <blocks>'
+    for block in blocks:
+        yield format_block(block,fmt,delimiter)
+
+def iter_blocks(arr,chunk=4096):
+    'splits the 2D array <arr> into row blocks of <chunk> rows'
+    for k in range(0,len(arr),chunk):
+        yield arr[k:k+chunk]
+
+def to_npy(arr)->bytes:
+    'numpy .npy file content of <arr>'
+    bio = io.BytesIO()
+    np.save(bio,arr,allow_pickle=False)
+    return bio.getvalue()
+
+def to_npz(**arrays)->bytes:
+    'compressed numpy .npz file content of the named <arrays>'
+    bio = io.BytesIO()
+    np.savez_compressed(bio,**arrays)
+    return bio.getvalue()
+
+def write_npy(f,blocks,shape,dtype='<f8'):
+    'writes a .npy file of <shape> to the binary file object <f>, the rows come block by block from <blocks>'
+    np.lib.format.write_array_header_1_0(f,{'descr':np.dtype(dtype).str,'fortran_order':False,'shape':tuple(shape)})
+    for block in blocks:
+        f.write(np.ascontiguousarray(block,dtype=dtype).tobytes())
+
+def write_npz(f,**members):
+    '''writes a compressed .npz file to the path or binary file object <f>. A member is an array or a
+       (blocks,shape,dtype) tuple for write_npy, whose blocks are compressed as they come'''
+    with zipfile.ZipFile(f,'w',compression=zipfile.ZIP_DEFLATED,allowZip64=True) as z:
+        for name,m in members.items():
+            with z.open(name + '.npy','w',force_zip64=True) as member:
+                if isinstance(m,tuple) : write_npy(member,*m)
+                else : np.lib.format.write_array(member,np.asanyarray(m),allow_pickle=False)
+
+def raw_bytes(raw)->bytes:
+    'headerless little endian 16bit image data, row by row'
+    return np.ascontiguousarray(raw,dtype='<u2').tobytes()
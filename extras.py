@@ -1,8 +1,13 @@
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
-import io
+import cv2
+from PIL import Image, ImageDraw
+import os
 import time
-import platform
+import functools
+import importlib.util
+import export
+from annotate import load_font
+from collections import namedtuple
 
 def preserve_sessionstate(session):
       'trick to preserve session state of the main page , see: https://discuss.streamlit.io/t/preserving-state-across-sidebar-pages/107/23      '
@@ -10,9 +15,15 @@ def preserve_sessionstate(session):
             session[k] = session[k]
 
 def np_to_csv_stream(im,fmt='%1.2f')->str:        
-        bio = io.BytesIO()
-        np.savetxt(bio,im,fmt=fmt,delimiter=' ')
-        return bio.getvalue().decode('latin1')     
+        return ''.join(export.iter_csv(export.iter_blocks(np.asarray(im).reshape(len(im),-1)),fmt))
+
+@functools.lru_cache(maxsize=None)
+def p2pro_cmd():
+    'the p2pro-cmd module (usb control commands), the dash in the file name prevents a plain import'
+    spec = importlib.util.spec_from_file_location('p2pro_cmd',os.path.join(os.path.dirname(os.path.abspath(__file__)),'p2pro-cmd.py'))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
 
 def c_to_f(x):
     return x * 1.8 + 32  
@@ -30,6 +41,56 @@ def find_tmin(temp):
     m = np.unravel_index(m, np.array(temp).shape)
     return (m[1],m[0]) , temp[m]
 
+framestats = namedtuple('framestats','min max mean center argmin argmax percentiles rois')
+framestats.__doc__ = '''statistics of one frame, the first four fields are the history columns.
+argmin and argmax are (x,y) positions, rois is a list of framestats, one per ROI'''
+
+def clip_roi(roi,shape):
+    'the (x,y,w,h) rectangle <roi> clipped to an image of <shape> (rows,cols), ValueError if nothing is left'
+    x,y,w,h = (int(v) for v in roi)
+    x0,y0 = max(x,0),max(y,0)
+    x1,y1 = min(x+w,shape[1]),min(y+h,shape[0])
+    if x1 <= x0 or y1 <= y0 :
+        raise ValueError(f'ROI {x},{y},{w},{h} is outside of the {shape[1]}x{shape[0]} image')
+    return x0,y0,x1-x0,y1-y0
+
+def frame_stats(img,rois=(),percentiles=(),convert=None)->framestats:
+    '''min,max,mean,center value and the (x,y) positions of min and max of the 2D <img> in
+       two passes (cv2.minMaxLoc and cv2.mean) plus optional <percentiles> in %.
+       <rois> is a list of (x,y,w,h) rectangles whose stats are computed in the same call, they are
+       clipped to the image (ValueError if a ROI is completely outside).
+       <img> may be the raw uint16 plane, <convert> then maps the values to temperatures
+       (e.g. p2pro.raw_to_temperature). For uint16 images the percentiles come from one histogram'''
+    if img.strides[1] != img.itemsize or img.strides[0] <= 0 : # cv2 can not handle e.g. rotated views
+        img = np.ascontiguousarray(img)
+    mi,ma,locmin,locmax = cv2.minMaxLoc(img)
+    values = [mi,ma,cv2.mean(img)[0],img[img.shape[0]//2,img.shape[1]//2]]
+    if len(percentiles) :
+        if img.dtype == np.uint16 :
+            cdf = np.cumsum(np.bincount(img.ravel(),minlength=65536))
+            values += list(np.searchsorted(cdf,np.asarray(percentiles)/100*(cdf[-1]-1),side='right'))
+        else :
+            values += list(np.percentile(img,percentiles))
+    if convert is not None :
+        values = [float(v) for v in convert(np.array(values,dtype=np.float64))]
+    else :
+        values = [float(v) for v in values]
+    stats = []
+    for roi in rois :
+        x,y,w,h = clip_roi(roi,img.shape)
+        s = frame_stats(img[y:y+h,x:x+w],percentiles=percentiles,convert=convert)
+        stats.append(s._replace(argmin=(s.argmin[0]+x,s.argmin[1]+y),argmax=(s.argmax[0]+x,s.argmax[1]+y)))
+    return framestats(*values[:4],locmin,locmax,tuple(values[4:]),stats)
+
+def rotate_point(pos,rot,shape):
+    'the (x,y) position <pos> in an image of <shape> (rows,cols) after rotate(image,rot)'
+    x,y = pos
+    h,w = shape[:2]
+    if rot == 90 : return (y,w-1-x)
+    if rot == 180 : return (w-1-x,h-1-y)
+    if rot == 270 : return (h-1-y,x)
+    return (x,y)
+
 def rotate(temp,rot):        
         if rot == 90 : return np.rot90(temp,1)
         if rot == 180 : return np.rot90(temp,2)
@@ -41,12 +102,6 @@ def draw_annotation(image,pos,text,color='red',fontsize=15,dotsize=4):
         Checks for image borders and adjusts the the text position so the text remains visible
 
         '''
-        # check that the font is actually available!
-        if platform.system() == 'Windows':
-            fonttype='arial.ttf'
-        else :
-             fonttype='DejaVuSans.ttf'
-
         draw = ImageDraw.Draw(image)
         s = dotsize/2
         x1 = abs(pos[0]-s)
@@ -56,7 +111,7 @@ def draw_annotation(image,pos,text,color='red',fontsize=15,dotsize=4):
         draw.ellipse((x1,y1,x2,y2), fill=color, 
                 outline=color, width=1)
     
-        font = ImageFont.truetype(fonttype, fontsize,)
+        font = load_font(fontsize) # loaded only once
         tl = int(draw.textlength(text,font))
         # give some offset if text is near the border:
         w,h = image.size
@@ -66,14 +121,14 @@ def draw_annotation(image,pos,text,color='red',fontsize=15,dotsize=4):
         else : y = pos[1]
 
         draw.text((x,y),text,fill=color,font=font )
-        del draw # potential memory leak here!
+        del draw
 
 
 def convert_colormap(temp,colormapper):
-    temp = colormapper(temp)
-    temp = np.uint8(temp * 255)
-    im = Image.fromarray(temp)
-    return im
+    'PIL image of the [0,1] normalized <temp> array, colorized with the matplotlib colormap <colormapper>'
+    from colormap import colormapper as lutmapper
+    rgb = lutmapper(colormapper.name,min(colormapper.N,256)).apply(temp,0.,1.)
+    return Image.fromarray(rgb)
     
 
 def colorbarfig(min,max,cmapname):
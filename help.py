@@ -1,13 +1,55 @@
 
 history_timerange = '''
-internally the data within the time range is interpolated if there are more than 1024 data points to avoid a slowdown
-of the app due to the plotting routine. This may give some display artifacts where the displayed data seems to change
-constantly. However the original data is left untouched. 
+long time ranges are shown from a decimation pyramid that the history builds while the data comes in. Each point
+then stands for a block of samples: the min trace shows the block minimum, the max trace the block maximum,
+mean the block average and center both extremes, so short peaks stay visible. The original data is left untouched.
 '''
-history_wait_delay = '''add delay to reduce framerate and lower cpu usage'''
+fps = '''target rate of the display updates. It is lowered automatically if the cpu budget is exceeded'''
 
-cam_id = 'on windows the camera id is an integer (0,1,2..), on linux a string like /dev/..'
+cpu_budget = '''cpu use of the display of this browser tab (its loop and render threads) that the frame rate control aims for,
+100% is one core. Under load the display rate goes down
+and the chart and colorbar are updated less often, the acquisition and the history are not affected'''
+
+cam_id = '''on windows the camera id is an integer (0,1,2..), on linux a string like /dev/..
+
+without camera: file:<recording>[,rate] replays a raw recording, synthetic:[rate] shows a generated scene.
+rate is realtime (default), fast or frames per second'''
 
 image_width = 'in pixels, set to 0 to make the video as wide as the window (default)'
 
-tsr = 'The total cumber of the samples of the history buffer is 10000. A lower sample rate translates to a longer history and vice versa'
\ No newline at end of file
+tsr = 'The total cumber of the samples of the history buffer is 10000. A lower sample rate translates to a longer history and vice versa'
+
+logfile = 'file name for a persistent history without length limit. An existing log is continued. Leave empty for the in memory history'
+
+record = 'writes every raw 16bit frame at the full camera rate into a compressed file in the working directory (see recorder.py)'
+
+encoding = 'how the thermal image is sent to the browser. png is lossless, jpeg is smaller and faster to encode'
+
+scale = 'integer upscaling of the thermal image before the color mapping, smoother edges and sharper cursor labels but more cpu load'
+
+workers = 'number of threads that render consecutive frames in parallel, more than the number of cpu cores does not help'
+
+display = '''server: the thermal image is colormapped and encoded on the server (uses the image settings of the sidebar).
+browser: only the compressed raw frames are sent, colormap, rotation, range and cursors are applied in the browser and can be changed
+there without a round trip. Needs much less server cpu and bandwidth per viewer. Blur/sharpen and upscaling are not applied'''
+
+raw_port = '''port of the server that sends the raw frames to the browser view, the browser must be able to reach it on the
+host of this page. It listens on the streamlit server.address, only on localhost if that is not set (set it and open the port
+in a firewall for remote viewers), and only this page may read the frames. Served over http, so not from an https page'''
+
+threshold = '''the image is only rendered and sent again if the scene changed by more than this temperature (compared are
+8x8 pixel means, so the sensor noise does not count). The stats and the history are updated for every frame. 0 sends every frame'''
+
+profile = '''times the stages of the acquisition, rendering and display (rolling window of the last 512 runs each) and counts
+frames, unchanged and dropped frames. Applies to the whole app, negligible cost when off'''
+
+profile_file = 'if set, the timings and counters are written to this json file every 2 s'
+
+sampling = '''records the python stacks of all threads for the given number of frames. The most frequent functions are shown
+here, the full stacks are saved in a .stacks file (collapsed format, e.g. for flamegraph.pl or speedscope)'''
+
+memdiag = '''tracks the memory of the process: the resident size and its trend in MB per hour, and with tracemalloc the
+code lines whose allocations grew most since switching this on. Sampled every minute. Slows the app down, use only for diagnosis'''
+
+emissivity = '''emissivity of the measured surface, sent to the camera (TPD parameter) over its usb control channel when changed.
+Needs pyusb and access to the usb device, a failed command is shown here'''
\ No newline at end of file
@@ -1,76 +1,480 @@
 import numpy as np
 import time
-import io
+import os
+import bisect
+import threading
+import export
 
-def hreduce(data,pts):    
-    xn = np.linspace(data[0].min(),data[0].max(),pts)
-    n = data.shape[0]
-    out = np.zeros((n,pts))
-    out[0] = xn
-    for k in range(1,n):        
-        out[k] = np.interp(xn,data[0],data[k])
-    return out
+REDUCERS = ('min','max','mean','minmax')
+
+
+def _check_reduce(reduce,columns):
+    reduce = tuple(reduce) if reduce else ('minmax',)*columns
+    assert len(reduce) == columns and set(reduce) <= set(REDUCERS), f'reduce must be {columns} of {REDUCERS}'
+    return reduce
+
+
+class _ring:
+
+    def __init__(self,maxitems,rows,dtype=np.float32) -> None:
+        'fixed size circular storage of <rows> values per time stamp, the time is kept in float64'
+        self.maxitems = maxitems
+        self.t = np.zeros(maxitems,dtype=np.float64)
+        self.mem = np.zeros((rows,maxitems),dtype=dtype)
+        self.items = 0
+        self.pos = 0 # write position of the next item
+
+    def append(self,t,row):
+        self.t[self.pos] = t
+        self.mem[:,self.pos] = row
+        self.pos = (self.pos + 1) % self.maxitems
+        if self.items < self.maxitems :
+            self.items += 1
+
+    def extend(self,t,rows):
+        'append many items at once, <rows> has the shape (rows,n)'
+        n = len(t)
+        if n > self.maxitems :
+            t,rows,n = t[-self.maxitems:],rows[:,-self.maxitems:],self.maxitems
+        k = min(n,self.maxitems - self.pos)
+        self.t[self.pos:self.pos+k] = t[:k]
+        self.mem[:,self.pos:self.pos+k] = rows[:,:k]
+        self.t[:n-k] = t[k:]
+        self.mem[:,:n-k] = rows[:,k:]
+        self.pos = (self.pos + n) % self.maxitems
+        self.items = min(self.items + n,self.maxitems)
+
+    def _phys(self,k):
+        'physical index of the logical index <k>, 0 is the oldest item'
+        return (self.pos - self.items + k) % self.maxitems
+
+    def segments(self,k0,k1):
+        'the one or two physical slices that hold the logical range k0:k1'
+        if k1 <= k0 : return []
+        p0 = self._phys(k0)
+        if p0 + k1 - k0 <= self.maxitems : return [slice(p0,p0+k1-k0)]
+        return [slice(p0,self.maxitems),slice(0,p0+k1-k0-self.maxitems)]
+
+    def tat(self,k):
+        'time stamp of the logical index <k>'
+        return self.t[self._phys(k)]
+
+    def window(self,k0,k1):
+        'copy of the logical range k0:k1 as (rows+1,n) array, time in row 0'
+        out = np.empty((self.mem.shape[0]+1,max(k1-k0,0)))
+        j = 0
+        for s in self.segments(k0,k1):
+            n = s.stop - s.start
+            out[0,j:j+n] = self.t[s]
+            out[1:,j:j+n] = self.mem[:,s]
+            j += n
+        return out
+
+    def search(self,tval,side='left'):
+        'logical index of <tval> in the time ordered items, same meaning as np.searchsorted'
+        k = 0
+        for s in self.segments(0,self.items):
+            i = np.searchsorted(self.t[s],tval,side)
+            if i < s.stop - s.start : return k + i
+            k += s.stop - s.start
+        return k
+
+
+class _pyramid:
+
+    def __init__(self,maxitems,columns,reduce,factor=4,capacity=None,source=None) -> None:
+        '''incremental min/max/mean decimation of a sample stream. Level L holds buckets of factor**(L+1)
+           samples, aligned to the absolute sample count, so old buckets never change.
+           Each level keeps <capacity> buckets (default: enough to cover <maxitems> samples).
+           With a <source> (function that returns the sample arrays t,v so far, e.g. of a memory map)
+           the levels are built from it when they are first selected, not up front'''
+        self.cols = columns
+        self.source = source
+        self.factor = factor
+        self.reduce = reduce
+        self.levels = []
+        size = factor
+        while size <= maxitems :
+            n = capacity if capacity else maxitems//size + 2
+            # rows: last time of the bucket, min, max, mean and 1 if the min came first for every column
+            self.levels.append(dict(size=size,ring=_ring(n,1+4*columns,np.float64),count=0,
+                               tfirst=0.,tlast=0.,min=np.zeros(columns),max=np.zeros(columns),
+                               sum=np.zeros(columns),n=0,tmin=np.zeros(columns),tmax=np.zeros(columns)))
+            size *= factor
+        self.built = len(self.levels) if source is None else 0 # the levels below are complete and fed
+
+    def add(self,t,row):
+        v = np.asarray(row,dtype=np.float64)
+        self._feed(0,t,t,v,v,v,1,t,t)
+
+    def _feed(self,L,tfirst,tlast,vmin,vmax,vsum,n,tmin,tmax):
+        'adds a sample or a bucket of the level below, <tmin> and <tmax> are the times of its extremes'
+        if L >= self.built : return # not built yet, its build reads the sample from the source
+        lv = self.levels[L]
+        if lv['count'] == 0 :
+            lv['tfirst'] = tfirst
+            lv['min'][:] = vmin
+            lv['max'][:] = vmax
+            lv['sum'][:] = vsum
+            lv['n'] = n
+            lv['tmin'][:] = tmin
+            lv['tmax'][:] = tmax
+        else :
+            lower,higher = vmin < lv['min'],vmax > lv['max'] # ties keep the earlier extreme
+            np.copyto(lv['tmin'],tmin,where=lower)
+            np.copyto(lv['tmax'],tmax,where=higher)
+            np.minimum(lv['min'],vmin,out=lv['min'])
+            np.maximum(lv['max'],vmax,out=lv['max'])
+            lv['sum'] += vsum
+            lv['n'] += n
+        lv['tlast'] = tlast
+        lv['count'] += 1
+        if lv['count'] == self.factor : # bucket complete
+            lv['count'] = 0
+            lv['ring'].append(lv['tfirst'],np.concatenate(((lv['tlast'],),lv['min'],lv['max'],lv['sum']/lv['n'],lv['tmin'] <= lv['tmax'])))
+            self._feed(L+1,lv['tfirst'],lv['tlast'],lv['min'],lv['max'],lv['sum'],lv['n'],lv['tmin'],lv['tmax'])
+
+    def rebuild(self,t,v,chunk=2**20):
+        '''fill all levels from the complete sample arrays <t> (n,) and <v> (n,columns) at once,
+           e.g. from a memory map. Each level reads only the samples it keeps, in chunks of about <chunk> samples'''
+        for lv in self.levels :
+            self._rebuild_level(lv,t,v,chunk)
+        self.built = len(self.levels)
+
+    def build(self,L):
+        'builds level <L> and the levels below it from the source, if not done yet'
+        while self.built <= L :
+            t,v = self.source()
+            self._rebuild_level(self.levels[self.built],t,v)
+            self.built += 1
+
+    def _rebuild_level(self,lv,t,v,chunk=2**20):
+        N = len(t)
+        S = lv['size']
+        nb = N//S # complete buckets
+        step = max(chunk//S,1)
+        for b0 in range(max(nb - lv['ring'].maxitems,0),nb,step):
+            b1 = min(b0 + step,nb)
+            tt = np.asarray(t[b0*S:b1*S]).reshape(-1,S)
+            vv = np.asarray(v[b0*S:b1*S],dtype=np.float64).reshape(-1,S,self.cols)
+            minfirst = vv.argmin(1) <= vv.argmax(1)
+            lv['ring'].extend(tt[:,0],np.concatenate((tt[None,:,-1],vv.min(1).T,vv.max(1).T,vv.mean(1).T,minfirst.T)))
+        # the incomplete bucket holds all complete buckets of the level below
+        sub = S//self.factor
+        p0,p1 = nb*S,(N//sub)*sub
+        lv['count'] = (p1-p0)//sub
+        if lv['count'] :
+            vv = np.asarray(v[p0:p1],dtype=np.float64)
+            lv['tfirst'],lv['tlast'] = t[p0],t[p1-1]
+            lv['min'][:],lv['max'][:],lv['sum'][:] = vv.min(0),vv.max(0),vv.sum(0)
+            lv['n'] = p1-p0
+            tp = np.asarray(t[p0:p1])
+            lv['tmin'][:],lv['tmax'][:] = tp[vv.argmin(0)],tp[vv.argmax(0)]
+
+    def select(self,samples,tstart,max_samples):
+        '''the finest level that shows <samples> samples with at most <max_samples> points and still reaches back to <tstart>.
+           A level that is not built yet is built now'''
+        per_bucket = 2 if 'minmax' in self.reduce else 1
+        for L,lv in enumerate(self.levels) :
+            if samples*per_bucket/lv['size'] > max_samples : continue
+            ring = lv['ring']
+            if L < self.built :
+                reaches = ring.items and ring.tat(0) <= tstart
+            else : # the first bucket it would keep, without building it
+                t,_ = self.source()
+                nb = len(t)//lv['size']
+                reaches = nb and t[max(nb - ring.maxitems,0)*lv['size']] <= tstart
+            if reaches :
+                self.build(L)
+                return lv
+        if not self.levels : return None
+        self.build(len(self.levels)-1)
+        return self.levels[-1]
+
+    def window(self,lv,tstart,tend):
+        '''the decimated data between <tstart> and <tend> as (columns+1,n) array like history.timerange.
+           The incomplete newest bucket is included if it falls into the range'''
+        ring = lv['ring']
+        b = ring.window(ring.search(tstart),ring.search(tend,'right'))
+        tf,tl = b[0],b[1]
+        c = self.cols
+        mn,mx,me,mf = b[2:2+c],b[2+c:2+2*c],b[2+2*c:2+3*c],b[2+3*c:]
+        if lv['count'] and tstart <= lv['tfirst'] <= tend :
+            tf,tl = np.append(tf,lv['tfirst']),np.append(tl,lv['tlast'])
+            mn = np.column_stack((mn,lv['min']))
+            mx = np.column_stack((mx,lv['max']))
+            me = np.column_stack((me,lv['sum']/lv['n']))
+            mf = np.column_stack((mf,lv['tmin'] <= lv['tmax']))
+        if 'minmax' not in self.reduce : # one point per bucket
+            out = np.empty((c+1,len(tf)))
+            out[0] = (tf+tl)/2
+            for k,r in enumerate(self.reduce):
+                out[k+1] = {'min':mn,'max':mx,'mean':me}[r][k]
+            return out
+        out = np.empty((c+1,2*len(tf))) # two points per bucket: at the first and the last sample time
+        out[0,0::2],out[0,1::2] = tf,tl
+        for k,r in enumerate(self.reduce):
+            if r == 'minmax' : # in the order in which the extremes occurred
+                first = mf[k] > 0
+                out[k+1,0::2] = np.where(first,mn[k],mx[k])
+                out[k+1,1::2] = np.where(first,mx[k],mn[k])
+            else :
+                out[k+1] = np.repeat({'min':mn,'max':mx,'mean':me}[r][k],2)
+        return out
 
 
 class history:
 
-    def __init__(self,maxitems=5000,columns=3) -> None:  
-        '''A fifo buffer for numpy fp numbers with time axis in seconds
+    closed = False
+
+    def __init__(self,maxitems=5000,columns=3,reduce=None,clock=time.time) -> None:
+        '''A fifo ring buffer for numpy fp numbers with time axis in seconds
            The number of columns is free to choose. The total number of columns
-           will be columns+1
-        '''      
+           will be columns+1. Adding is O(1), the time is kept in float64.
+           <reduce> sets per column how long time ranges are decimated for display:
+           'min','max','mean' or 'minmax' (default, keeps both peaks).
+           <clock> returns the time in seconds of an added sample
+        '''
         self.maxitems = maxitems
+        self.clock = clock
         self.cols = columns
-        self.mem = np.zeros((self.cols+1,self.maxitems),dtype=np.float32)
-        self.items = 0
-        self.tcreated = time.time()
+        self.reduce = _check_reduce(reduce,columns)
+        self.lock = threading.RLock() # adding and reading may happen in different threads
+        self.clear()
+
+    @property
+    def items(self):
+        return self.ring.items
 
     def length_s(self):
-        return self.mem[0,self.items-1]
-    
+        return self.ring.tat(self.items-1)
+
     def clear(self):
         'clear the memory and reset the timer'
-        self.mem = np.zeros((self.cols+1,self.maxitems),dtype=np.float32)
-        self.items = 0
-        self.tcreated = time.time()
+        with self.lock:
+            self.ring = _ring(self.maxitems,self.cols)
+            self.pyramid = _pyramid(self.maxitems,self.cols,self.reduce)
+            self.tcreated = self.clock()
 
     def head(self,num):
-        'get the last num elements'
+        'get the last num elements, oldest first'
         assert num >= 1, f'num must be >=1 , got {num}'
-        if num > self.items :
-            num = self.items                
-        return self.mem[:,self.items-1:self.items-num:-1]
-        
+        with self.lock:
+            if num > self.items :
+                num = self.items
+            return self.ring.window(self.items-num,self.items)
+
     def timerange(self,range_s,offset_s=0,max_samples=500):
-        if self.items == 0 : return None
-        t = self.mem[0][:self.items]
-        tmax = t[self.items-1]
-        koff = np.searchsorted(t,tmax-offset_s) - 1
-        if koff < 0 : koff = 0        
-        kend = np.searchsorted(t,tmax - offset_s - range_s) - 1
-        if kend < 0 : kend = 0
-        #print(koff,kend,self.items)        
-        if koff-kend < max_samples :
-            #return self.mem[:,koff:kend:-1]
-            return self.mem[:,kend:koff]
-        else : # reduce samples for plotly
-            return hreduce(self.mem[:,kend:koff],max_samples)
-                
+        '''the data of the last <range_s> seconds, ending <offset_s> before the newest sample.
+           Longer ranges come from the decimation pyramid, then the result has about <max_samples> points'''
+        with self.lock:
+            if self.closed or self.items == 0 : return None
+            tend = self.length_s() - offset_s
+            tstart = tend - range_s
+            kend = self.ring.search(tend,'right')
+            kstart = self.ring.search(tstart)
+            if kend-kstart <= max_samples :
+                return self.ring.window(kstart,kend)
+            lv = self.pyramid.select(kend-kstart,max(tstart,self.ring.tat(0)),max_samples)
+            if lv is None : return self.ring.window(kstart,kend)
+            return self.pyramid.window(lv,tstart,tend)
+
     def add(self,row:tuple):
         'add a full row : row is a tuple with columns elements'
-        t = time.time() - self.tcreated
-        if self.items < self.maxitems :
-            self.mem[:,self.items] = (t,)+row
-            self.items += 1
-        else:            
-            self.mem = np.roll(self.mem,-1,axis=None,)            
-            self.mem[:,self.maxitems-1] = (t,)+row
+        with self.lock:
+            t = self.clock() - self.tcreated
+            self.ring.append(t,row)
+            self.pyramid.add(t,row)
+
+    def _snapshot(self,n=None):
+        '''(n,copy) of the first <n> (default all) samples: a bounded history is copied at once, new samples
+           shift it. The copy is None for an unbounded one, it only grows and its first n samples never change'''
+        with self.lock:
+            n = self.items if n is None else n
+            return n,(self.ring.window(0,n).T if self.maxitems is not None else None)
+
+    def blocks(self,chunk=4096,n=None):
+        'generator of (n,columns+1) row blocks of the first <n> (default all) samples, see _snapshot()'
+        return self._blocks(chunk,*self._snapshot(n))
+
+    def _blocks(self,chunk,n,copy):
+        if copy is not None :
+            yield from export.iter_blocks(copy,chunk)
+            return
+        for k in range(0,n,chunk):
+            with self.lock: # not held between the blocks
+                block = self.ring.window(k,min(k+chunk,n)).T
+            yield block
+
+    def iter_csv(self,fmt='%1.2f',chunk=4096):
+        'generator of csv text chunks of the full history'
+        return export.iter_csv(self.blocks(chunk),fmt)
+
+    def csv(self,fmt='%1.2f',chunk=4096)->str:
+        return ''.join(self.iter_csv(fmt,chunk))
+
+    def save(self,f,fmt='csv',csvfmt='%1.2f',chunk=4096):
+        '''writes the full history to the binary file object <f> block by block, the memory use does not
+           grow with the history length. <fmt> is 'csv', 'npy' or 'npz' (see npy() and npz())'''
+        n,copy = self._snapshot() # one for all members, t and data must not shift against each other
+        if fmt == 'csv' :
+            for text in export.iter_csv(self._blocks(chunk,n,copy),csvfmt) : f.write(text.encode())
+        elif fmt == 'npy' :
+            export.write_npy(f,self._blocks(chunk,n,copy),(n,self.cols+1))
+        elif fmt == 'npz' :
+            export.write_npz(f,t=((b[:,0] for b in self._blocks(chunk,n,copy)),(n,),'<f8'),
+                             data=((b[:,1:] for b in self._blocks(chunk,n,copy)),(n,self.cols),'<f4'),tcreated=self.tcreated)
+        else :
+            raise ValueError(f'unknown export format {fmt}')
+
+    def npy(self)->bytes:
+        '.npy file content: (n,columns+1) float64 array, time in column 0'
+        with self.lock:
+            w = self.ring.window(0,self.items)
+        return export.to_npy(w.T)
+
+    def npz(self)->bytes:
+        '.npz file content: float64 time <t> and float32 <data> of shape (n,columns)'
+        with self.lock:
+            w = self.ring.window(0,self.items)
+        return export.to_npz(t=w[0],data=w[1:].T.astype(np.float32),tcreated=self.tcreated)
+
+
+class _filestore:
+
+    INDEX_STEP = 1024 # every INDEX_STEP-th time stamp is kept in memory for searching
+    HEADER = np.dtype([('magic','S8'),('cols','<u4'),('version','<u4'),('items','<u8'),('tcreated','<f8'),('reserved','S32')])
+    MAGIC = b'P2PROHST'
+
+    def __init__(self,path,columns,chunk=65536,clock=time.time) -> None:
+        '''append only storage of (float64 time, float32 columns) records in a memory mapped file.
+           Has the same interface as _ring. An existing file is attached, not overwritten'''
+        self.path = path
+        self.cols = columns
+        self.chunk = chunk
+        self.clock = clock
+        self.rec = np.dtype([('t','<f8'),('v','<f4',(columns,))])
+        if not os.path.exists(path) or os.path.getsize(path) < self.HEADER.itemsize :
+            self._create()
+        self._map()
+        hdr = self.hdr[0]
+        if hdr['magic'] != self.MAGIC or hdr['cols'] != columns :
+            raise ValueError(f'{path} is no history log with {columns} columns')
+        self.items = int(hdr['items'])
+        self.tcreated = float(hdr['tcreated'])
+        self.tindex = list(self.mm['t'][:self.items:self.INDEX_STEP])
+
+    def _create(self):
+        hdr = np.zeros(1,dtype=self.HEADER)
+        hdr['magic'] = self.MAGIC
+        hdr['cols'] = self.cols
+        hdr['version'] = 1
+        hdr['tcreated'] = self.clock()
+        with open(self.path,'wb') as f:
+            f.write(hdr.tobytes())
+            f.truncate(self.HEADER.itemsize + self.chunk*self.rec.itemsize)
+
+    def _map(self):
+        capacity = (os.path.getsize(self.path) - self.HEADER.itemsize)//self.rec.itemsize
+        self.hdr = np.memmap(self.path,dtype=self.HEADER,mode='r+',shape=(1,))
+        self.mm = np.memmap(self.path,dtype=self.rec,mode='r+',offset=self.HEADER.itemsize,shape=(capacity,))
+
+    def _grow(self):
+        self.flush()
+        capacity = len(self.mm) + self.chunk
+        del self.mm,self.hdr # the file can only be resized without a mapping on windows
+        with open(self.path,'r+b') as f:
+            f.truncate(self.HEADER.itemsize + capacity*self.rec.itemsize)
+        self._map()
+
+    def flush(self):
+        self.mm.flush()
+        self.hdr.flush()
+
+    def close(self):
+        self.flush()
+        del self.mm,self.hdr
+
+    def clear(self):
+        'drop all records and reset the time axis'
+        self.close()
+        self._create()
+        self._map()
+        self.items = 0
+        self.tcreated = float(self.hdr[0]['tcreated'])
+        self.tindex = []
+
+    @property
+    def t(self):
+        return self.mm['t'][:self.items]
+
+    @property
+    def v(self):
+        return self.mm['v'][:self.items]
+
+    def append(self,t,row):
+        if self.items == len(self.mm) : self._grow()
+        self.mm[self.items] = (t,row)
+        if self.items % self.INDEX_STEP == 0 : self.tindex.append(t)
+        self.items += 1
+        self.hdr['items'] = self.items
+
+    def tat(self,k):
+        return self.mm['t'][k]
+
+    def window(self,k0,k1):
+        'copy of the records k0:k1 as (columns+1,n) array, time in row 0'
+        r = self.mm[k0:k1]
+        out = np.empty((self.cols+1,len(r)))
+        out[0] = r['t']
+        out[1:] = r['v'].T
+        return out
+
+    def search(self,tval,side='left'):
+        'same as np.searchsorted on the time stamps, only one index block is read from the file'
+        j = (bisect.bisect_left if side == 'left' else bisect.bisect_right)(self.tindex,tval)
+        lo = max(j-1,0)*self.INDEX_STEP
+        hi = min(j*self.INDEX_STEP+1,self.items)
+        return lo + int(np.searchsorted(self.mm['t'][lo:hi],tval,side))
+
+
+class filehistory(history):
+
+    LEVELS = 11 # pyramid levels up to 4**11 samples per bucket
+
+    def __init__(self,path,columns=3,reduce=None,chunk=65536,capacity=2048,clock=time.time) -> None:
+        '''A history that is kept in the memory mapped file <path> instead of RAM, for unbounded logging:
+           the RAM use is constant, the file grows in steps of <chunk> records.
+           An existing log is reattached and continued without reading it, a level of the decimation
+           pyramid (<capacity> buckets per level) is built from the file when a long time range first needs it.
+        '''
+        self.path = path
+        self.maxitems = None # unbounded
+        self.clock = clock
+        self.cols = columns
+        self.reduce = _check_reduce(reduce,columns)
+        self.lock = threading.RLock()
+        self.capacity = capacity
+        self.ring = _filestore(path,columns,chunk,clock)
+        self.tcreated = self.ring.tcreated
+        self.pyramid = _pyramid(4**self.LEVELS,columns,self.reduce,capacity=capacity,source=lambda : (self.ring.t,self.ring.v))
+
+    def clear(self):
+        'clear the log file and reset the timer'
+        with self.lock:
+            self.ring.clear()
+            self.tcreated = self.ring.tcreated
+            self.pyramid = _pyramid(4**self.LEVELS,self.cols,self.reduce,capacity=self.capacity)
+
+    def flush(self):
+        self.ring.flush()
+
+    def close(self):
+        'closes the file, afterwards timerange() returns None'
+        with self.lock:
+            self.ring.close()
+            self.closed = True
 
-    def csv(self,fmt='%1.2f')->str:        
-        bio = io.BytesIO()
-        np.savetxt(bio, self.mem[:,:self.items].T,fmt=fmt,delimiter=' ')
-        return bio.getvalue().decode('latin1')        
-        
 
 def main():
     import matplotlib.pyplot as plt
@@ -79,7 +483,7 @@ def main():
     h = history(maxitems=7)
     for k in range(9):
         h.add((10+k,20+k,30+k))
-        time.sleep(0.0001)    
+        time.sleep(0.0001)
     ax.plot(h.head(5)[0],h.head(5)[1:].T)
     plt.show()
 
@@ -0,0 +1,106 @@
+import threading
+from collections import namedtuple
+from p2pro import raw_to_temperature
+from extras import frame_stats
+from profiler import prof
+
+hubframe = namedtuple('hubframe','seq t raw video temp stats')
+hubframe.__doc__ = '''one processed frame as published by the hub. The arrays are shared
+between all subscribers and read only, stats are frame_stats of temp'''
+
+
+class hub:
+
+    def __init__(self,camera,history,history_rate=2.,slots=8) -> None:
+        '''process wide acquisition: the <camera> reads in its threaded mode (see p2pro.start), one thread
+           takes the newest frame, converts it to temperature, computes the stats and adds them to the <history>
+           with <history_rate> samples per second. A slow conversion skips frames instead of delaying the capture.
+           Recorders and other camera sinks still get every frame.
+           Each processed frame is published once, any number of display sessions read it
+           with latest(), wait() or since() independent of each other'''
+        self.camera = camera
+        self.history = history
+        self.history_rate = history_rate
+        self.lock = threading.Lock() # guards the history swap
+        self.slots = [None]*slots
+        self.seq = -1 # sequence number of the newest frame
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.error = None # exception that stopped the acquisition
+        self.fps = 0. # measured acquisition rate
+
+    def start(self):
+        if self.thread is not None : return
+        self.camera.start()
+        self.running = True
+        self.error = None
+        self.thread = threading.Thread(target=self._run,name='p2pro-hub',daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None :
+            self.thread.join(2.)
+            self.camera.stop() # after the thread, it may wait for a frame
+        self.thread = None
+
+    def release(self):
+        'stop the acquisition and free the camera'
+        self.stop()
+        if self.camera is not None : self.camera.release()
+
+    def set_history(self,history):
+        'replaces the history while running, returns the old one'
+        with self.lock:
+            old,self.history = self.history,history
+        return old
+
+    def _run(self):
+        tnext = 0.
+        try:
+            while self.running:
+                with prof.stage('capture'):
+                    raw,video = self.camera.frames()
+                t = self.camera.t # capture time
+                with prof.stage('convert'):
+                    temp = raw_to_temperature(raw)
+                with prof.stage('stats'):
+                    stats = frame_stats(temp)
+                prof.count('captured')
+                if t >= tnext :
+                    with self.lock,prof.stage('history add'):
+                        self.history.add(stats[:4])
+                    tnext = max(tnext + 1/self.history_rate,t) # no burst after a stall
+                self._publish(t,raw,video,temp,stats)
+        except Exception as e:
+            self.error = e
+            self.running = False
+            with self.cond:
+                self.cond.notify_all()
+
+    def _publish(self,t,raw,video,temp,stats):
+        for a in (raw,video,temp): a.flags.writeable = False
+        with self.cond:
+            if self.seq >= 0 : self.fps = 0.9*self.fps + 0.1/max(t - self.slots[self.seq % len(self.slots)].t,1e-6)
+            self.seq += 1
+            self.slots[self.seq % len(self.slots)] = hubframe(self.seq,t,raw,video,temp,stats)
+            self.cond.notify_all()
+
+    def latest(self)->hubframe:
+        'the newest frame without waiting, None if there is none'
+        with self.cond:
+            return self.slots[self.seq % len(self.slots)] if self.seq >= 0 else None
+
+    def wait(self,seq,timeout=None)->hubframe:
+        'the newest frame if it is newer than <seq>, waits for it if needed. None on timeout or error'
+        with self.cond:
+            if not self.cond.wait_for(lambda : self.seq > seq or not self.running,timeout) : return None
+            if self.seq <= seq : return None
+            return self.slots[self.seq % len(self.slots)]
+
+    def since(self,seq)->list:
+        'all frames newer than <seq> that are still kept, oldest first'
+        with self.cond:
+            n = min(self.seq - seq,len(self.slots),self.seq + 1)
+            return [self.slots[k % len(self.slots)] for k in range(self.seq - n + 1,self.seq + 1)]
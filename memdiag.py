@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import tracemalloc
+import collections
+import numpy as np
+
+'''
+memory diagnostics for long runs: the resident set size over time with its trend and, with
+tracemalloc, the allocation sites that grew most since the start of the diagnostics.
+tracemalloc slows down all allocations, it only runs while the diagnostics are on.
+'''
+
+def rss():
+    'resident set size of the process in bytes, None if unknown'
+    try:
+        import psutil # optional
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    if sys.platform.startswith('linux') :
+        with open('/proc/self/statm') as f :
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    if sys.platform == 'win32' :
+        import ctypes
+        from ctypes import wintypes
+        class counters(ctypes.Structure):
+            _fields_ = [('cb',wintypes.DWORD),('PageFaultCount',wintypes.DWORD)] + \
+                       [(name,ctypes.c_size_t) for name in ('PeakWorkingSetSize','WorkingSetSize','QuotaPeakPagedPoolUsage',
+                        'QuotaPagedPoolUsage','QuotaPeakNonPagedPoolUsage','QuotaNonPagedPoolUsage','PagefileUsage','PeakPagefileUsage')]
+        c = counters()
+        c.cb = ctypes.sizeof(c)
+        ok = ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),ctypes.byref(c),c.cb)
+        return c.WorkingSetSize if ok else None
+    return None
+
+
+class memdiag:
+
+    def __init__(self,maxitems=1440,frames=10) -> None:
+        '''keeps <maxitems> samples of (time,rss,traced memory). tracemalloc stores <frames> frames
+           per allocation, more frames show the callers but cost more'''
+        self.samples = collections.deque(maxlen=maxitems)
+        self.frames = frames
+        self.baseline = None
+        self.top = []
+
+    @property
+    def running(self):
+        return self.baseline is not None
+
+    def start(self):
+        if self.running : return
+        tracemalloc.start(self.frames)
+        self.baseline = self._snapshot()
+        self.samples.clear()
+        self.sample()
+
+    def stop(self):
+        if not self.running : return
+        self.baseline = None
+        tracemalloc.stop()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False,tracemalloc.__file__),
+            tracemalloc.Filter(False,'<frozen importlib._bootstrap*>'),
+            tracemalloc.Filter(False,'<unknown>')))
+
+    def sample(self,top=10):
+        'records the memory now and updates the <top> growing allocation sites'
+        traced = tracemalloc.get_traced_memory()[0] if self.running else 0
+        self.samples.append((time.time(),rss() or 0,traced))
+        if self.running :
+            stats = self._snapshot().compare_to(self.baseline,'lineno')
+            self.top = [s for s in stats if s.size_diff > 0][:top]
+
+    def trend(self):
+        'growth of the rss in MB per hour, least squares fit of the samples'
+        if len(self.samples) < 3 : return 0.
+        t,m,_ = np.array(self.samples).T
+        if t[-1] - t[0] <= 0 : return 0.
+        return np.polyfit((t - t[0])/3600,m/2**20,1)[0]
+
+    def text(self):
+        if not self.samples : return 'no samples'
+        t,m,traced = self.samples[-1]
+        lines = [f'rss {m/2**20:.1f} MB, trend {self.trend():+.2f} MB/h over {(t-self.samples[0][0])/60:.0f} min',
+                 f'traced by python {traced/2**20:.1f} MB']
+        for s in self.top :
+            frame = s.traceback[0]
+            lines.append(f'{s.size_diff/1024:+9.1f} kB {s.count_diff:+7d} blocks  {os.path.basename(frame.filename)}:{frame.lineno}')
+        return '\n'.join(lines)
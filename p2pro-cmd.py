@@ -2,9 +2,17 @@ import enum
 import struct
 import time
 import logging
-
-import usb.util
-import usb.core
+import queue
+import threading
+import operator
+import array
+from concurrent.futures import Future
+
+try:
+    import usb.util
+    import usb.core
+except ImportError:     # only needed for a real camera, SimDevice works without
+    usb = None
 
 log = logging.getLogger(__name__)
 
@@ -76,13 +84,21 @@ class CmdCode(enum.IntEnum):
 
 
 class P2Pro:
-    _dev: usb.core.Device
+    _dev: "usb.core.Device"
 
-    def __init__(self):
+    def __init__(self, dev=None):
+        """
+        :param dev: transport with the ctrl_transfer() method of a pyusb device, e.g. a SimDevice.
+                    None opens the real camera
+        """
+        if dev is not None:
+            self._dev = dev
+            return
+        if usb is None:
+            raise ImportError("pyusb is needed to talk to the camera")
         self._dev = usb.core.find(idVendor=0x0BDA, idProduct=0x5830)
         if (self._dev == None):
             raise FileNotFoundError("Infiray P2 Pro thermal module not found, please connect and try again!")
-        pass
 
     def _check_camera_ready(self) -> bool:
         """
@@ -98,21 +114,28 @@ class P2Pro:
             raise UserWarning(f"vdcmd status error {ret[0]:#X}")
         return False
 
+    poll_min = 0.00005  # first delay between two ready checks in s
+    poll_max = 0.004    # longest delay between two ready checks in s
+
     def _block_until_camera_ready(self, timeout: int = 5) -> bool:
         """
-        Blocks until the camera is ready or the timeout is reached
+        Blocks until the camera is ready or the timeout is reached.
+        Checks immediately, then with a delay that starts at poll_min and doubles up to poll_max,
+        so short commands return quickly and slow ones (flash writes..) do not flood the bus
 
         :param timeout: Timeout in seconds
         :return: True if the camera is ready, False if the timout occured
         :raises UserWarning: When the return code of the camera is abnormal
         """
-        start = time.time()
+        start = time.perf_counter()
+        delay = self.poll_min
         while True:
             if (self._check_camera_ready()):
                 return True
-            time.sleep(0.001)
-            if (time.time() > start + timeout):
+            if (time.perf_counter() > start + timeout):
                 return False
+            time.sleep(delay)
+            delay = min(delay * 2, self.poll_max)
 
     def _long_cmd_write(self, cmd: int, p1: int, p2: int, p3: int = 0, p4: int = 0):
         data1 = struct.pack("<H", cmd)
@@ -254,9 +277,186 @@ class P2Pro:
         return res
     
 
+
+class SimDevice:
+    """
+    In-process emulation of the vendor control transfers of the camera, a transport for P2Pro(dev=SimDevice()).
+    Writes to 0x9d00 store the 8 byte command header, 0x1d00 stores it and executes. Payload goes to 0x9d08 + offset,
+    a write to 0x1d08 + offset stores and executes the command. Results are read from 0x1d08 (standard commands)
+    and 0x1d10 (long commands), the status byte from 0x200: bits 0/1 busy, bits 2-7 error (a failed command stays busy).
+    Each transfer takes <latency> s and each command keeps the device busy for <busy> s.
+    SET commands store their payload, GET commands return it (zeros if never set), so chunked transfers can be checked.
+    """
+    LONG_CMDS = (CmdCode.prop_tpd_params,)
+    BUSY = 0x01
+    ERROR = 0x04
+
+    def __init__(self, latency: float = 0, busy: float = 0):
+        self.latency = latency
+        self.busy = busy
+        self.transfers = 0
+        self.commands = 0
+        self._header = bytes(8)
+        self._data = bytearray(0x100)
+        self._result = b''
+        self._status = 0
+        self._ready = 0.    # perf_counter time when the running command is done
+        self.store = {}     # (cmd, param) -> payload
+        for info in DeviceInfoType:
+            self.store[(CmdCode.get_device_info, info)] = info.name[9:].encode()[:DeviceInfoType_len[info]].ljust(DeviceInfoType_len[info], b'\x00')
+        self.store[(CmdCode.cur_vtemp, 0)] = struct.pack('<H', 3000)
+        for tpd_param, value in ((PropTpdParams.TPD_PROP_DISTANCE, 41), (PropTpdParams.TPD_PROP_TU, 300), (PropTpdParams.TPD_PROP_TA, 300),
+                                 (PropTpdParams.TPD_PROP_EMS, 121), (PropTpdParams.TPD_PROP_TAU, 127), (PropTpdParams.TPD_PROP_GAIN_SEL, 1)):
+            self.store[(CmdCode.prop_tpd_params, tpd_param)] = struct.pack('>H', value)   # plausible start values
+        self.store[(CmdCode.pseudo_color, 0)] = bytes([PseudoColorTypes.PSEUDO_WHITE_HOT])
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue, wIndex, data_or_wLength=None, timeout=None):
+        self.transfers += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if bmRequestType == 0xC1:   # read
+            if wIndex == 0x200:
+                busy = self.BUSY if time.perf_counter() < self._ready else 0
+                return array.array('B', [self._status | busy])
+            if wIndex in (0x1d08, 0x1d10):
+                return array.array('B', self._result[:data_or_wLength].ljust(data_or_wLength, b'\x00'))
+            raise ValueError(f'read of unknown register {wIndex:#x}')
+        data = bytes(data_or_wLength)
+        if wIndex in (0x9d00, 0x1d00):
+            self._header = data
+            self._data[:] = bytes(0x100)
+        elif 0x9d08 <= wIndex < 0x9e08 or 0x1d08 <= wIndex < 0x1e08:
+            offset = (wIndex & 0x7fff) - 0x1d08
+            self._data[offset:offset + len(data)] = data
+        else:
+            raise ValueError(f'write to unknown register {wIndex:#x}')
+        if wIndex & 0x8000 == 0:
+            self._execute(wIndex == 0x1d00)
+        return len(data)
+
+    def _execute(self, header_only):
+        self.commands += 1
+        self._ready = time.perf_counter() + self.busy
+        self._status = 0
+        cmd = struct.unpack('<H', self._header[:2])[0]
+        code = cmd & ~int(CmdDir.SET)
+        if code in self.LONG_CMDS:
+            p1, p2 = struct.unpack('>HI', self._header[2:8])
+            dataLen = struct.unpack('>I', self._data[4:8])[0]
+            if cmd & CmdDir.SET:
+                self.store[(code, p1)] = struct.pack('>H', p2)
+            else:
+                self._result = self.store.get((code, p1), b'')[:dataLen]
+            return
+        param = struct.unpack('<I', self._header[2:6])[0]
+        length = struct.unpack('>H', self._header[6:8])[0]
+        if cmd & CmdDir.SET:
+            if header_only:
+                length = 0
+            self.store[(code, param)] = bytes(self._data[:length])
+        elif (code, param) in self.store:
+            self._result = self.store[(code, param)][:length]
+        elif code in (CmdCode.get_device_info, CmdCode.pseudo_color, CmdCode.cur_vtemp):
+            self._status = self.ERROR | self.BUSY   # unknown info type or preview path
+            self._result = b''
+        else:
+            self._result = bytes(length)
+
+
+class CmdWorker:
+    """
+    Runs all commands of a P2Pro in one worker thread that owns the USB handle, the callers never block.
+    Every method returns a concurrent.futures.Future. Commands are executed in the order they were submitted,
+    TPD parameter writes that are queued back to back are merged into one batch (the last value of a parameter wins)
+    and the device info, which never changes, is read only once.
+    """
+
+    def __init__(self, cam: P2Pro = None):
+        self._cam = cam if cam is not None else P2Pro()
+        self._queue = queue.Queue()
+        self._lock = threading.RLock()
+        self._submitted = 0         # number of submitted jobs
+        self._tpd_batch = None      # (future, params, job number) of a queued TPD write batch
+        self._info = {}             # device info cache
+        self._thread = threading.Thread(target=self._run, name='p2pro-cmd', daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args) -> Future:
+        """
+        Queues fn(cam, *args) for the worker thread
+
+        :return: Future of the result
+        """
+        fut = Future()
+        with self._lock:
+            self._submitted += 1
+            self._queue.put((fut, fn, args))
+        return fut
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            fut, fn, args = job
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                fut.set_result(fn(self._cam, *args))
+            except BaseException as e:
+                log.warning(f'p2pro command {getattr(fn, "__name__", fn)} failed: {e}')
+                fut.set_exception(e)
+
+    def close(self, timeout: float = 5):
+        """
+        Executes the queued commands and stops the worker
+        """
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def set_prop_tpd_params(self, tpd_param: PropTpdParams, value: int) -> Future:
+        # one critical section: _write_tpd closes the batch under the same lock, so a batch that is found here
+        # has not started yet
+        with self._lock:
+            batch = self._tpd_batch
+            if batch is not None and batch[2] == self._submitted and not batch[0].cancelled():  # still the last queued job
+                batch[1][tpd_param] = value
+                return batch[0]
+            params = {tpd_param: value}
+            fut = self.submit(self._write_tpd, params)
+            self._tpd_batch = (fut, params, self._submitted)
+            return fut
+
+    def _write_tpd(self, cam: P2Pro, params: dict):
+        with self._lock:
+            if self._tpd_batch is not None and self._tpd_batch[1] is params:
+                self._tpd_batch = None  # closed, later writes start a new batch
+        for tpd_param, value in params.items():
+            cam.set_prop_tpd_params(tpd_param, value)
+
+    def get_prop_tpd_params(self, tpd_param: PropTpdParams) -> Future:
+        return self.submit(operator.methodcaller('get_prop_tpd_params', tpd_param))
+
+    def pseudo_color_set(self, preview_path: int, color_type: PseudoColorTypes) -> Future:
+        return self.submit(operator.methodcaller('pseudo_color_set', preview_path, color_type))
+
+    def pseudo_color_get(self, preview_path: int = 0) -> Future:
+        return self.submit(operator.methodcaller('pseudo_color_get', preview_path))
+
+    def get_device_info(self, dev_info: DeviceInfoType) -> Future:
+        with self._lock:
+            if dev_info in self._info:
+                return self._info[dev_info]
+            fut = self._info[dev_info] = self.submit(operator.methodcaller('get_device_info', dev_info))
+        # a failed read is not cached
+        fut.add_done_callback(lambda f: f.exception() is None or self._info.pop(dev_info, None))
+        return fut
+
+
 if __name__ == '__main__':
+    import sys
 
-    cam_cmd = P2Pro()
+    cam_cmd = P2Pro(SimDevice()) if '--sim' in sys.argv else P2Pro()
     print(cam_cmd)
     print(cam_cmd._standard_cmd_read(CmdCode.cur_vtemp, 0, 2))
     #print(cam_cmd._standard_cmd_read(CmdCode.shutter_vtemp, 0, 2))
@@ -0,0 +1,214 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import signal
+import threading
+import time
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+
+from p2pro import raw_to_temperature,FRAME_SHAPE
+from replay import open_camera
+from history import filehistory
+from extras import frame_stats
+
+'''
+headless logger: the min,max,mean,center temperature of the whole frame and of optional ROIs
+in a memory mapped history log (see history.filehistory), no UI. Meant to run unattended as a service.
+
+python p2pro-log.py /dev/video0 --log p2pro.log --rate 1 --roi 100,80,40,30
+python p2pro-log.py synthetic: --log test.log --status status.json --port 8765
+
+The log is rotated (renamed with a time stamp) at --rotate-mb or --rotate-hours, --keep old logs are kept.
+The current values are written to --status as json and served on http://127.0.0.1:<port>/.
+A log written by this script can be opened in the app with the history log file setting
+if it has no ROIs (4 columns).
+'''
+
+log = logging.getLogger('p2pro-log')
+
+
+def parse_roi(s):
+    'x,y,w,h in pixels of the unrotated sensor image, the rectangle must lie inside the sensor'
+    try:
+        x,y,w,h = (int(v) for v in s.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'bad roi {s}, expected x,y,w,h')
+    rows,cols = FRAME_SHAPE[1:3]
+    if w <= 0 or h <= 0 or x < 0 or y < 0 or x+w > cols or y+h > rows :
+        raise argparse.ArgumentTypeError(f'bad roi {s}, must lie inside the {cols}x{rows} sensor')
+    return (x,y,w,h)
+
+
+def stats_row(stat):
+    'min,max,mean,center of the frame followed by those of each roi'
+    row = list(stat[:4])
+    for s in stat.rois : row += s[:4]
+    return row
+
+
+class logger:
+
+    def __init__(self,args) -> None:
+        self.args = args
+        self.cols = 4*(1+len(args.roi))
+        self.history = None
+        self.camera = None
+        self.status = dict(state='starting',pid=os.getpid(),log=args.log,rois=args.roi,samples=0,frames=0,errors=0)
+        self.lock = threading.Lock() # guards status
+        self.running = True
+
+    def open_log(self):
+        self.history = filehistory(self.args.log,columns=self.cols)
+        self.opened = time.time()
+        log.info(f'logging to {self.args.log}, {self.history.items} samples present')
+
+    def rotate_log(self):
+        '''renames the current log with a time stamp, starts a new one and deletes the oldest ones.
+           A log that could not be closed stays in use, a closed one is reopened even if the rename failed'''
+        self.history.close() # a failed close raises, the log is still open then
+        base,ext = os.path.splitext(self.args.log)
+        try:
+            stamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+            name,n = f'{base}_{stamp}{ext}',0
+            while os.path.exists(name): # more than one rotation per second
+                n += 1
+                name = f'{base}_{stamp}-{n}{ext}'
+            os.replace(self.args.log,name)
+            log.info(f'log rotated to {name}')
+        finally:
+            self.open_log() # a new log or, after a failed rename, the old one again
+        old = sorted(glob.glob(f'{glob.escape(base)}_????-??-??_??-??-??*{ext}'),key=os.path.getmtime)
+        for f in old[:max(len(old)-self.args.keep,0)]:
+            os.remove(f)
+            log.info(f'removed {f}')
+
+    def need_rotation(self):
+        a = self.args
+        if a.rotate_mb and self.history.ring.items * self.history.ring.rec.itemsize > a.rotate_mb * 2**20 : return True
+        if a.rotate_hours and time.time() - self.opened > a.rotate_hours * 3600 : return True
+        return False
+
+    def open_camera(self):
+        'opens the camera, retries with a growing delay until it works or we are stopped'
+        delay = 1.
+        while self.running:
+            try:
+                cam = open_camera(self.args.id)
+                cam.raw()
+                log.info(f'camera {self.args.id} opened')
+                return cam
+            except Exception as e:
+                self.set_status(state=f'no camera: {e}')
+                log.warning(f'camera {self.args.id}: {e}, retry in {delay:.0f}s')
+                time.sleep(delay)
+                delay = min(delay*2,60.)
+
+    def set_status(self,**kw):
+        with self.lock:
+            self.status.update(kw)
+
+    def get_status(self):
+        with self.lock:
+            return json.dumps(self.status)
+
+    def write_status(self):
+        'atomic replace, readers never see a half written file'
+        tmp = self.args.status + '.tmp'
+        with open(tmp,'w') as f : f.write(self.get_status())
+        os.replace(tmp,self.args.status)
+
+    def run(self):
+        a = self.args
+        self.open_log()
+        period = 1/a.rate
+        tnext = tstatus = tflush = 0.
+        frames = 0
+        while self.running:
+            if self.camera is None :
+                self.camera = self.open_camera()
+                if self.camera is None : break
+            try:
+                raw = self.camera.raw() # read every frame at the sensor rate, else the driver queue delivers old ones
+            except Exception as e:
+                log.warning(f'camera read failed: {e}')
+                self.set_status(state=f'camera error: {e}',errors=self.status['errors']+1)
+                self.camera.release()
+                self.camera = None
+                continue
+            frames += 1
+            t = time.time()
+            if t < tnext : continue
+            tnext = max(tnext + period,t) # no burst after a stall
+            try:
+                if self.history.closed : self.open_log() # the reopen of a rotation failed, retry
+                # stats on the raw data, only the few result values are converted to temperature
+                stat = frame_stats(raw,rois=a.roi,convert=raw_to_temperature)
+                row = stats_row(stat)
+                self.history.add(row)
+                self.set_status(state='running',time=t,frames=frames,samples=self.history.items,values=row)
+                if t - tflush > a.flush :
+                    self.history.flush()
+                    tflush = t
+                    if self.need_rotation() : self.rotate_log()
+            except Exception as e: # e.g. disk full, the service keeps running and retries with the next sample
+                log.warning(f'sample failed: {e}')
+                self.set_status(state=f'sample error: {e}',errors=self.status['errors']+1)
+            if a.status and t - tstatus > a.status_interval :
+                self.write_status()
+                tstatus = t
+        self.history.close()
+        if self.camera is not None : self.camera.release()
+        self.set_status(state='stopped')
+        if a.status : self.write_status()
+        log.info('stopped')
+
+    def stop(self,*_):
+        self.running = False
+
+
+def serve_status(lg,port):
+    'json status on http://127.0.0.1:<port>/ in a daemon thread'
+    class handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = lg.get_status().encode()
+            self.send_response(200)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self,*args): # no access log
+            pass
+    server = ThreadingHTTPServer(('127.0.0.1',port),handler)
+    threading.Thread(target=server.serve_forever,name='status-http',daemon=True).start()
+    return server
+
+
+def main():
+    default_id = '1' if platform.system() == 'Windows' else '/dev/video0'
+    parser = argparse.ArgumentParser(description='headless P2Pro temperature logger')
+    parser.add_argument('id',nargs='?',default=default_id,help='camera id, file:<recording> or synthetic:')
+    parser.add_argument('--log',default='p2pro.log',help='history log file, continued if it exists')
+    parser.add_argument('--rate',type=float,default=1.,help='samples per second (the camera is read at full rate)')
+    parser.add_argument('--roi',type=parse_roi,action='append',default=[],help='x,y,w,h region with its own columns, repeatable')
+    parser.add_argument('--rotate-mb',type=float,default=0,help='rotate the log at this size in MB, 0 = never')
+    parser.add_argument('--rotate-hours',type=float,default=0,help='rotate the log after this many hours, 0 = never')
+    parser.add_argument('--keep',type=int,default=10,help='number of rotated logs to keep')
+    parser.add_argument('--flush',type=float,default=10.,help='seconds between flushes of the log to disk')
+    parser.add_argument('--status',help='json status file, rewritten every --status-interval seconds')
+    parser.add_argument('--status-interval',type=float,default=5.)
+    parser.add_argument('--port',type=int,help='serve the json status on this local port')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,format='%(asctime)s %(levelname)s %(message)s')
+
+    lg = logger(args)
+    signal.signal(signal.SIGINT,lg.stop)
+    signal.signal(signal.SIGTERM,lg.stop)
+    if args.port : serve_status(lg,args.port)
+    lg.run()
+
+
+if __name__ == '__main__':
+    main()
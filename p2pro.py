@@ -1,6 +1,9 @@
 import cv2
 import numpy as np
 import platform
+import threading
+import time
+import functools
 
 '''
 with info from , check out:
@@ -15,41 +18,237 @@ pip install opencv-python pyusb pyaudio  ffmpeg-python
 tested with cv2 4.8.0
 '''
 
+FRAME_SHAPE = (2,192,256,2) # upper/lower image, rows, columns, bytes per pixel
+
+
+def split_frame(frame):
+    '''returns (raw,video) views into a (2,192,256,2) byte frame without copying:
+       the lower half reinterpreted as little endian 16bit words and the lower bytes of the upper half'''
+    raw = frame[1].view('<u2')[:,:,0]
+    video = frame[0,:,:,0]
+    return raw,video
+
+
+@functools.lru_cache(maxsize=None)
+def temperature_lut(unit='C',dtype=np.float32):
+    '''returns the cached, read only 65536 entry table that maps every raw 16bit value
+       to a temperature in <unit> : 'C' Celsius, 'F' Fahrenheit or 'K' Kelvin'''
+    lut = _raw_to_unit(np.arange(65536),unit).astype(dtype)
+    lut.flags.writeable = False
+    return lut
+
+
+def _raw_to_unit(raw,unit):
+    t = raw/64 - 273.2 # Celsius scale
+    if unit == 'F' : return t * 1.8 + 32
+    if unit == 'K' : return t + 273.15
+    if unit != 'C' : raise ValueError(f'unknown temperature unit {unit}, use C, F or K')
+    return t
+
+
+def raw_to_temperature(raw,unit='C',dtype=np.float32,out=None):
+    '''converts raw 16bit sensor values to temperatures in <unit> with a single table lookup.
+       Non integer raw values (like averages) are converted arithmetically'''
+    raw = np.asarray(raw)
+    if raw.dtype.kind == 'f' :
+        return np.asarray(_raw_to_unit(raw,unit),dtype=dtype)
+    lut = temperature_lut(unit,np.dtype(dtype))
+    return np.take(lut,raw,out=out,mode='clip') # mode clip avoids a buffered copy of out
+
+
+class tempconverter:
+
+    def __init__(self,unit='C',dtype=np.float32) -> None:
+        '''raw to temperature conversion without any allocations per frame. The index and output
+           buffers are allocated once per image shape, the returned array is reused by the next call!'''
+        self.lut = temperature_lut(unit,np.dtype(dtype))
+        self.index = None
+        self.out = None
+
+    def __call__(self,raw,out=None):
+        if self.index is None or self.index.shape != raw.shape :
+            self.index = np.empty(raw.shape,dtype=np.intp)
+            self.out = np.empty(raw.shape,dtype=self.lut.dtype)
+        np.copyto(self.index,raw,casting='unsafe') # take() would allocate this index array itself
+        if out is None : out = self.out
+        return np.take(self.lut,self.index,out=out,mode='clip')
+
+
+class framebuffer:
+
+    def __init__(self,slots=16,shape=FRAME_SHAPE,dtype=np.uint8) -> None:
+        '''A preallocated ring buffer of frames with capture timestamps and sequence numbers.
+           One thread writes with put(), any number of readers get copies of the latest frame
+           or of all frames since a given sequence number. The lock is only held for the copies.
+        '''
+        self.slots = slots
+        self.frames = np.zeros((slots,)+tuple(shape),dtype=dtype)
+        self.times = np.zeros(slots,dtype=np.float64)
+        self.seqs = np.full(slots,-1,dtype=np.int64)
+        self.seq = -1 # sequence number of the newest frame, -1 = empty
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self,frame,t):
+        'copy <frame> into the next slot, <t> is the capture time'
+        with self.cond:
+            seq = self.seq + 1
+            k = seq % self.slots
+            np.copyto(self.frames[k],frame)
+            self.times[k] = t
+            self.seqs[k] = seq
+            self.seq = seq
+            self.cond.notify_all()
+
+    def latest(self,out=None):
+        'returns (seq,t,frame) of the newest frame or None if the buffer is empty'
+        with self.cond:
+            if self.seq < 0 : return None
+            k = self.seq % self.slots
+            if out is None : out = self.frames[k].copy()
+            else : np.copyto(out,self.frames[k])
+            return self.seq,self.times[k],out
+
+    def since(self,seq):
+        '''returns (seqs,times,frames) of all frames newer than <seq> that are still in the buffer,
+           oldest first. The arrays are empty if there is nothing new'''
+        with self.cond:
+            n = min(self.seq - seq,self.slots,self.seq + 1)
+            if n <= 0 :
+                return (np.zeros(0,dtype=np.int64),np.zeros(0),
+                        np.zeros((0,)+self.frames.shape[1:],dtype=self.frames.dtype))
+            k = np.arange(self.seq - n + 1,self.seq + 1) % self.slots
+            return self.seqs[k],self.times[k],self.frames[k] # fancy indexing copies
+
+    def wait(self,seq,timeout=None)->bool:
+        'blocks until a frame newer than <seq> is available, returns False on timeout or after close()'
+        with self.cond:
+            return self.cond.wait_for(lambda : self.seq > seq or self.closed,timeout) and self.seq > seq
+
+    def close(self):
+        'no more frames will come, wakes up the waiting readers'
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
 class p2pro:
 
     def __init__(self,cam_id) -> None:
         'module to read out the Infiray P2Pro camera'
+        self._setup()
+        self.cap = None
         if platform.system() == 'Windows': cam_id = int(cam_id)
         self.cap = cv2.VideoCapture(cam_id) 
         self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0) # do not create rgb data!
 
-    def get_frame(self):
+    def _setup(self):
+        'state of the frame reading, also used by the replay sources in replay.py'
+        self.buffer = None # framebuffer, only used in threaded mode
+        self.thread = None
+        self.running = False
+        self.error = None # exception that stopped the reader thread
+        self.seq = -1 # sequence number of the last frame returned by get_frame()
+        self.t = None # capture time of that frame
+        self.sinks = [] # objects with an add(raw,t) method that get every captured frame, e.g. a recorder
+
+    def _read(self):
+        'reads one frame from the device'
         ret, frame = self.cap.read()         
+        if not ret :
+            raise IOError('could not read a frame from the camera')
         if platform.system() == 'Windows':
-            frame = np.reshape(frame[0],(2,192,256,2))
+            frame = np.reshape(frame[0],FRAME_SHAPE)
         else : # Linux, MacOS
-            frame = np.reshape(frame,(2,192,256,2))
+            frame = np.reshape(frame,FRAME_SHAPE)
+        return frame
+
+    def start(self,slots=16):
+        '''start the threaded acquisition mode: a reader thread fills a ring buffer of <slots> frames
+           at the full sensor rate, independent of how long the caller needs per frame'''
+        if self.thread is not None : return
+        self.buffer = framebuffer(slots)
+        self.seq = -1 # the numbers of the new buffer start again
+        self.error = None
+        self.running = True
+        self.thread = threading.Thread(target=self._reader,name='p2pro-reader',daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        'stop the reader thread, get_frame() reads synchronously again'
+        self.running = False
+        if self.thread is not None :
+            self.thread.join(2.)
+            self.buffer.close()
+        self.thread = None
+        self.buffer = None
+
+    def _reader(self):
+        try:
+            while self.running:
+                frame = self._read()
+                t = time.time()
+                self.buffer.put(frame,t)
+                self._publish(frame,t)
+        except Exception as e:
+            self.error = e
+            self.running = False
+            self.buffer.close()
+
+    def _publish(self,frame,t):
+        for sink in list(self.sinks):
+            sink.add(split_frame(frame)[0],t)
+
+    def latest(self,out=None):
+        'threaded mode: (seq,t,frame) of the newest frame without blocking, None if there is none yet'
+        return self.buffer.latest(out)
+
+    def since(self,seq):
+        'threaded mode: (seqs,times,frames) of all buffered frames newer than <seq>'
+        return self.buffer.since(seq)
+
+    def get_frame(self,out=None,timeout=2.):
+        '''returns the next frame. In threaded mode this is the newest frame from the buffer,
+           it waits only if the caller is faster than the camera.
+           <out> is an optional (2,192,256,2) uint8 array that receives the frame'''
+        buffer = self.buffer
+        if buffer is None :
+            self.seq += 1
+            frame = self._read()
+            self.t = time.time()
+            self._publish(frame,self.t)
+            if out is None : return frame
+            np.copyto(out,frame)
+            return out
+        if not buffer.wait(self.seq,timeout) :
+            raise IOError(f'no frame from the camera reader thread: {self.error or "timeout"}')
+        self.seq,self.t,frame = buffer.latest(out)
         return frame
 
+    def frames(self,out=None):
+        '''returns (raw,video) from one single capture: the 16bit raw image and the 8bit video image.
+           Both are views into the frame buffer (or into <out> if given), nothing is copied'''
+        return split_frame(self.get_frame(out))
+
     def raw(self):
         'returns the raw 16bit int image'
-        frame = self.get_frame()
-        raw = frame[1,:,:,:].astype(np.intc) # select only the lower image part
-        raw = (raw[:,:,1] << 8) + raw[:,:,0] # assemble the 16bit word
-        return raw
+        return self.frames()[0]
     
     def video(self):
         'returns the normal 8bit video stream from the upper half'
-        frame = self.get_frame()
-        return frame[0,:,:,0] # select only the upper image part, lower byte                
+        return self.frames()[1]
     
-    def temperature(self):
-        'returns the image as temperature map in Celsius'
-        raw = self.raw()        
-        return raw/64 - 273.2 # convert to Celsius scale
+    def temperature(self,unit='C',dtype=np.float32,out=None):
+        'returns the image as temperature map in Celsius (or Fahrenheit or Kelvin, see temperature_lut)'
+        return raw_to_temperature(self.raw(),unit,dtype,out)
     
+    def release(self):
+        'stop the reader thread and free the device'
+        self.stop()
+        if self.cap is not None : self.cap.release()
+
     def __del__(self):
-        self.cap.release()
+        self.release()
          
 
 def main():
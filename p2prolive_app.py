@@ -1,26 +1,47 @@
 import streamlit as st
-import numpy as np
-import time
+import plotly.graph_objects as go
+import base64
 import cv2
-from PIL import Image
-import plotly.express as px
-import matplotlib.pyplot as plt
-from history import history
-from p2pro import p2pro
-from extras import find_tmin,find_tmax,draw_annotation,rotate,preserve_sessionstate,colorbarfig,mytimer
+import numpy as np
+from history import history,filehistory
+from recorder import recorder
+from datetime import datetime
+from replay import open_camera
+from hub import hub
+from colormap import cmaplist,colorbar
+from pipeline import executor,ENCODINGS
+from extras import rotate,preserve_sessionstate,p2pro_cmd
+from scheduler import scheduler
+from profiler import prof
+from memdiag import memdiag
 import help
 import sys
 import platform
+import os
+import time
 
 st.set_page_config('P2Pro LIVE',initial_sidebar_state='expanded',page_icon='🔺',layout='wide')
 session = st.session_state
 
-# https://matplotlib.org/stable/gallery/color/colormap_reference.html
-cmaplist = ['jet','gray','bone', 'cividis','rainbow','terrain','nipy_spectral','gist_ncar','brg','hot','plasma', 'viridis','inferno', 'magma','afmhot','tab20c']
-
 HISTORY_LEN =  10000 # length of the history buffer in samples
+HISTORY_REDUCE = ('min','max','mean','minmax') # decimation of the min,max,mean,center columns
+
+def make_history():
+    'in memory history or, if a log file is set, a memory mapped one that survives restarts'
+    if session.logfile :
+        try:
+            return filehistory(session.logfile,columns=4,reduce=HISTORY_REDUCE)
+        except (OSError,ValueError) as e:
+            st.error(f'can not use the history log file: {e}')
+    return history(maxitems=HISTORY_LEN,columns=4,reduce=HISTORY_REDUCE)
+
+def open_history():
+    'switch the history of the running acquisition'
+    old = init().set_history(make_history())
+    if isinstance(old,filehistory):
+        old.close()
+
 if 'history' not in session : # init and set default values for sidebar controls
-    session.history = history(maxitems=HISTORY_LEN,columns=4)
     session.tsr = 2.
     if platform.system() == 'Windows':
         session.id = '1'
@@ -43,18 +64,87 @@ if 'history' not in session : # init and set default values for sidebar controls
     session.toff = 0.
     session.width = 0
     session.cheight = 300
-    session.wait_delay = 50
+    session.fps = 10.
+    session.cpu_budget = 100
     session.t_units = 's'
     session.showscale = True
+    session.logfile = ''
+    session.record = False
+    session.encoding = 'png'
+    session.scale = 1
+    session.display = 'server'
+    session.raw_port = 8765
+    session.threshold = 0.1
+    session.profile = False
+    session.profile_file = ''
+    session.profile_frames = 100
+    session.memdiag = False
+    session.emissivity = None # read from the camera below
+    session.workers = max(min((os.cpu_count() or 1)-1,3),1)
 
     if len(sys.argv) > 1 : # cmdline overwrite for the device id, use '--' in front of the argument!
         session.id = sys.argv[1]
+    if len(sys.argv) > 2 : # optional history log file
+        session.logfile = sys.argv[2]
 
 else :    
     preserve_sessionstate(session)    
 
+@st.cache_resource
+def acquisition():
+    '''process wide state of the shared acquisition: the camera id and the number of restarts,
+       which tells the other sessions that the hub was replaced'''
+    return dict(id=session.id,restarts=0)
+
+acq = acquisition()
+session.id = acq['id'] # all sessions show the camera that is in use
+
+def toggle_record():
+    'start or stop recording every raw frame of the camera to a file'
+    cam = init().camera
+    sinks = cam.sinks if cam is not None else [] # None if no camera could be opened
+    if session.record and cam is None :
+        session.record = False
+    elif session.record :
+        session.recorder = recorder(f'{datetime.now():%Y-%m-%d_%H-%M-%S}_p2pro.p2raw')
+        sinks.append(session.recorder)
+    elif session.get('recorder') is not None :
+        if session.recorder in sinks : sinks.remove(session.recorder)
+        session.recorder.close()
+        session.recorder = None
+
+@st.cache_resource
+def get_cmd():
+    '''the p2pro-cmd module and its command worker, which owns the usb control channel of the camera.
+       Raises if pyusb is missing or the camera is not found'''
+    mod = p2pro_cmd()
+    return mod,mod.CmdWorker()
+
+def set_emissivity():
+    # the worker runs the command, the script does not wait for the usb transfers
+    try:
+        mod,cmd = get_cmd()
+        session.cmd_result = cmd.set_prop_tpd_params(mod.PropTpdParams.TPD_PROP_EMS,round(session.emissivity*127))
+        session.ems_unknown = None
+    except Exception as e:
+        session.cmd_result = e
+
+def read_emissivity():
+    'the emissivity the camera uses, 0.95 if it can not be read'
+    try:
+        mod,cmd = get_cmd()
+        return round(cmd.get_prop_tpd_params(mod.PropTpdParams.TPD_PROP_EMS).result(timeout=1.)/127,2)
+    except Exception as e:
+        session.ems_unknown = f'camera value unknown: {e}'
+        return 0.95
+
+if session.emissivity is None : session.emissivity = read_emissivity() # once per session
+
 def restart():
+    acq['id'] = session.id # whichever session builds the new hub uses it
+    init().release() # stop the acquisition thread of the old camera, the history is kept
     init.clear()    
+    acq['restarts'] += 1
 
 with st.sidebar:
     with st.expander('color scaling',expanded=True):
@@ -88,23 +178,91 @@ with st.sidebar:
         st.text_input('camera id',on_change=restart,key='id',help=help.cam_id)
         st.number_input('image width',step=50,key='width',help=help.image_width)
         st.number_input('chart height',step=50,key='cheight')
-        st.number_input('wait delay ms',min_value=0,step=10,help=help.history_wait_delay,key='wait_delay')
+        st.radio('colormapping',('server','browser'),horizontal=True,key='display',help=help.display)
+        if session.display == 'browser' :
+            st.number_input('raw frame port',min_value=1024,max_value=65535,key='raw_port',help=help.raw_port)
+        st.selectbox('image encoding',ENCODINGS[1:],key='encoding',help=help.encoding)
+        st.number_input('image change threshold C',min_value=0.,step=0.05,key='threshold',help=help.threshold)
+        st.selectbox('image upscaling',(1,2,3,4),key='scale',help=help.scale)
+        st.number_input('render threads',min_value=1,max_value=16,key='workers',help=help.workers)
+        st.number_input('display fps',min_value=0.5,max_value=50.,step=1.,key='fps',help=help.fps)
+        st.number_input('cpu budget %',min_value=5,max_value=800,step=10,key='cpu_budget',help=help.cpu_budget)
+        if session.get('load') is not None :
+            st.caption(session.load)
+        st.number_input('emissivity',min_value=0.01,max_value=1.,step=0.01,key='emissivity',on_change=set_emissivity,help=help.emissivity)
+        if session.get('ems_unknown') : st.caption(session.ems_unknown)
+        r = session.get('cmd_result')
+        if r is not None and not isinstance(r,Exception) and r.done() : r = r.exception()
+        if isinstance(r,Exception) :
+            st.warning(f'camera command failed: {r}')
+        st.text_input('history log file',on_change=open_history,key='logfile',help=help.logfile)
+        st.checkbox('record raw frames',on_change=toggle_record,key='record',help=help.record)
+        if session.get('recorder') is not None :
+            st.caption(f'{session.recorder.path}: {session.recorder.frames} frames, {session.recorder.dropped} dropped')
+    with st.expander('profiling',expanded=session.profile):
+        st.checkbox('stage timers',key='profile',help=help.profile)
+        st.text_input('metrics file',key='profile_file',help=help.profile_file)
+        c1,c2 = st.columns(2)
+        c1.number_input('frames',min_value=1,step=50,key='profile_frames')
+        if c2.button('sampling profile',disabled=prof.sampling,help=help.sampling) :
+            prof.start_sampling(session.profile_frames,path=f'{datetime.now():%Y-%m-%d_%H-%M-%S}_p2pro.stacks')
+        if st.button('reset timers') : prof.reset()
+        profile_panel = st.empty()
+        if prof.report : st.code(prof.report)
+        st.checkbox('memory diagnostics',key='memdiag',help=help.memdiag)
+        memory_panel = st.empty()
+prof.enabled = session.profile # process wide, the hub and the render threads are shared
+
+@st.cache_resource
+def get_memdiag():
+    return memdiag() # one for the process
+
+@st.cache_resource
+def get_feed(port):
+    '''the frame server of the browser colormapping, one per process and port. It listens on the address
+       of the streamlit server (localhost if not set) and answers only its pages'''
+    from rawview import rawfeed
+    return rawfeed(port,host=st.get_option('server.address') or '127.0.0.1',page_port=st.get_option('server.port')).start()
+
+mem = get_memdiag()
+if session.memdiag : mem.start()
+else : mem.stop()
+
+def show_image(placeholder,data,mime='image/png',style=None):
+    '''encoded image as inline html. Unlike st.image no media file is stored on the server,
+       those are only freed when the script run ends, which the display loop never does.
+       The default <style> is the image width setting'''
+    if style is None : style = f'width:{session.width}px' if session.width > 0 else 'width:100%'
+    placeholder.markdown(f'<img src="data:{mime};base64,{base64.b64encode(data).decode()}" style="{style}">',unsafe_allow_html=True)
+
+def encode_png(image):
+    'RGB or gray numpy image to png bytes'
+    return cv2.imencode('.png',np.ascontiguousarray(image[...,::-1] if image.ndim == 3 else image))[1].tobytes()
 
 @st.cache_resource
 def init():
-    p2 = p2pro(session.id)
+    '''one acquisition for all browser sessions: the hub thread reads the camera, converts
+       to temperature, computes the stats and feeds the history. Sessions only display'''
+    cam_id = acquisition()['id'] # not the id of this session, it may not have seen the latest change
+    hb = hub(None,session.history if 'history' in session else make_history(),session.tsr)
     try:
-        p2.raw()
-    except Exception:
-        st.error(f'this seems to be no P2Pro cam ☹. Check connections and the camera id string, currently: {session.id}')
-    return p2
+        hb.camera = open_camera(cam_id) # real camera, file: replay or synthetic: scene
+        hb.camera.raw()
+    except Exception as e:
+        st.error(f'this seems to be no P2Pro cam ☹. Check connections and the camera id string, currently: {cam_id} ({e})')
+    else:
+        hb.start()
+    return hb
 
-p2 = init()
+restarts = acq['restarts'] # before init(), a restart in between only causes one rerun too many
+hb = init()
+session.history = hb.history # shared by all sessions
+hb.history_rate = session.tsr
 
 ##### define placeholders for the loop output:
 info = st.empty() 
 chart = st.empty()
-if session.showscale :
+if session.showscale and session.display == 'server' : # the browser view has its own scale
     c1,c2 = st.columns((0.9,0.1))
     img = c1.empty()
     img_cbar = c2.empty()
@@ -112,97 +270,129 @@ else:
     img = st.empty()
 img2 = st.empty()
 
-cm_hot = plt.get_cmap(session.colormap)     
+if session.display == 'server' : # rotate, filter, colormap, annotate and encode of consecutive frames in parallel threads
+    renderer = executor(hb,workers=session.workers).start()
+else : # only the compressed raw frames are sent, the browser does the rest
+    from rawview import rawview
+    renderer = None
+    try:
+        feed = get_feed(session.raw_port)
+    except OSError as e:
+        st.error(f'can not serve the raw frames on port {session.raw_port}: {e}')
+        st.stop()
+    feed.hub = hb
+    feed.detector.threshold = session.threshold * 64 # shared, the last session to set it wins
+    with img: # created once, the frames are fetched by the component
+        rawview(session.raw_port,session.colormap,session.rotate,session.autoscale,session.tmin,session.tmax,session.annotations,session.width)
+cbar = colorbar() # cached, redrawn only when the rounded range changes
+last_cbar = None
+
+# frame rate and periodic tasks, adapted to the cpu load of this session: its loop and its render threads,
+# the shared acquisition and the other sessions do not count
+clock = (lambda : time.thread_time() + renderer.cpu_time) if renderer is not None else time.thread_time
+sch = scheduler(session.fps,session.cpu_budget/100,clock=clock)
+sch.task('chart',1/session.tsr,adaptive=True)
+sch.task('colorbar',0.5,adaptive=True)
+sch.task('load',2.)
+sch.task('profile',2.)
+sch.task('memory',60.)
 
-tm = mytimer()       
-tm.add('chart',1/session.tsr)
-tm.add('history',1/session.tsr)
-tm.add('colorbar',0.5)
-tm.add('restart',500)
+# the chart figure is built once, only the data of its traces is replaced
+fig = go.Figure(layout=dict(height=session.cheight,margin=dict(l=0,r=0,t=20,b=0),yaxis_title='temperature in C',
+                            xaxis_title='time in minutes' if session.t_units == 'm' else 'time in seconds'))
+for name,color in (('min','blue'),('max','red'),('mean','green'),('center','orange')):
+    fig.add_scatter(x=[],y=[],mode='lines',name=name,line=dict(color=color))
     
-while True:    # main aquisition loop
-        
-    temp = p2.temperature()  
-    temp = rotate(temp,session.rotate)
-    session.last_image = temp
+seq = -1
+shown = -1 # sequence number of the displayed image
+last_values = None
+last_error = None
+try:
+    while True:    # main display loop, the acquisition runs in the hub and the rendering in the executor
+        sch.start_frame()
+        with prof.stage('wait frame'):
+            fr = hb.wait(seq,2.) # newest frame for the stats, the image only if it changed
+        if fr is None :
+            if acq['restarts'] != restarts : # restart() in any session replaced the hub
+                st.rerun()
+            error = f'no frames from the camera: {hb.error or ("stopped" if not hb.running else "timeout")}'
+            if error != last_error : info.error(error)
+            last_error,last_values = error,None # the metrics are shown again with the next frame
+            if not hb.running : time.sleep(1.) # until the camera id is changed in some session
+            sch.end_frame()
+            continue
+        last_error = None
+        seq = fr.seq # the frame is shared and read only
+        session.last_image = rotate(fr.temp,session.rotate) # only views
+        session.last_raw = rotate(fr.raw,session.rotate)
        
-    if session.annotations :  
-        idxmax,ma = find_tmax(temp)
-        idxmin,mi = find_tmin(temp)
-    idc = (temp.shape[1]//2,temp.shape[0]//2)
-    mc = temp[idc[::-1]] # why is that reverse needed???
-
-    stat = (temp.min(),temp.max(),temp.mean(),mc)  
-    if tm.check('history') : # add history data
-        session.history.add(stat)        
-
-    if session.timeline and tm.check('chart'):# The chart display increases cpu load. ~2 updates/s                
-        data = session.history.timerange(session.trange,session.toff,max_samples=1024)            
-        if data is not None:    
-            fig = px.line(x=None, y=None,height=session.cheight)  
-            if session.t_units == 'm' : 
-                t = data[0]/60         
-                labels = {'xaxis_title':"time in minutes",'yaxis_title':"temperature in C"}
-            else :
-                t = data[0]
-                labels = {'xaxis_title':"time in seconds",'yaxis_title':"temperature in C"}    
-            fig.update_layout(labels)
-            if session.show_min : fig.add_scatter(x=t, y=data[1],mode='lines',name='min',line=dict(color="blue"))
-            if session.show_max : fig.add_scatter(x=t, y=data[2],mode='lines',name='max',line=dict(color="red"))
-            if session.show_mean : fig.add_scatter(x=t, y=data[3],mode='lines',name='mean',line=dict(color="green"))        
-            if session.show_center : fig.add_scatter(x=t, y=data[4],mode='lines',name='center',line=dict(color="orange"))        
-            chart.plotly_chart(fig,use_container_width=True)            
-    
-    c1,c2,c3,c4 = info.columns(4) 
-    c1.metric('min',value=f"{stat[0]:1.4}C")
-    c2.metric('max',value=f"{stat[1]:1.4}C")
-    c3.metric('avg',value=f"{stat[2]:1.4}C")
-    c4.metric('center',value=f"{stat[3]:1.4}C")
+        stat = fr.stats # min,max,mean,center and the min/max positions of the unrotated frame
+
+        if session.timeline and sch.due('chart'): # The chart display increases cpu load, its rate adapts to the load
+            with sch.stage('chart'),prof.stage('chart'):
+                session.history = hb.history # replaced by open_history() of any session
+                data = session.history.timerange(session.trange,session.toff,max_samples=1024)            
+                if data is not None:    
+                    t = data[0]/60 if session.t_units == 'm' else data[0]
+                    show = (session.show_min,session.show_max,session.show_mean,session.show_center)
+                    with fig.batch_update():
+                        for k,trace in enumerate(fig.data):
+                            trace.x,trace.y,trace.visible = t,data[k+1],show[k]
+                    chart.plotly_chart(fig,use_container_width=True)            
     
-    # from here on we start to mod the temp data!
-    if session.sharp < 0:
-        temp = cv2.blur(temp, (-session.sharp+1,-session.sharp+1)) 
-    if session.sharp >= 1 :
-        kernel = np.array([[0, -1, 0], [-1, 5, -1], [0, -1, 0]])
-        temp = cv2.filter2D(temp, -1, kernel)        
+        values = [f"{v:1.4}C" for v in stat[:4]]
+        if values != last_values : # nothing is sent if the displayed values did not change
+            with prof.stage('push metrics'):
+                c1,c2,c3,c4 = info.columns(4) 
+                c1.metric('min',value=values[0])
+                c2.metric('max',value=values[1])
+                c3.metric('avg',value=values[2])
+                c4.metric('center',value=values[3])
+            last_values = values
     
-    if session.autoscale :
-        temp = (temp-stat[0])/(stat[1]-stat[0]) * session.contrast + session.brightness
-        if session.showscale and tm.check('colorbar') :
-            f = colorbarfig(stat[0],stat[1],session.colormap)
-            img_cbar.pyplot(f)            
-            del f            
-    else :        
-        temp = (temp-session.tmin)/(session.tmax-session.tmin) * session.contrast + session.brightness
-        if session.showscale and tm.check('colorbar'):
-            f = colorbarfig(session.tmin,session.tmax,session.colormap)
-            img_cbar.pyplot(f)            
-            del f
-    # trick to use the matplotlib colormaps with PIL
-    temp = cm_hot(temp)    
-    temp = np.uint8(temp * 255)
-    im = Image.fromarray(temp)    
-               
-    if session.annotations :    
-        draw_annotation(im,idxmax,f'{ma:1.2f}C')
-        draw_annotation(im,idxmin,f'{mi:1.2f}C',color='lightblue')
-        draw_annotation(im,idc,f'{mc:1.2f}C',color='lightblue')    
-
-    if session.width  > 0 : 
-        img.image(im,width=session.width,clamp=True,) 
-    else :
-        img.image(im,clamp=True,use_column_width=True)    
-                      
-    if session.showvideo :
-        v = p2.video()
-        v = rotate(v,session.rotate)        
-        if session.width  > 0 : 
-            img2.image(v,width=session.width,clamp=True,) 
+        changed = False
+        if renderer is None : # colormapped in the browser, the feed sends only visibly changed frames
+            if feed.count != shown :
+                shown = feed.count
+                changed = True
         else :
-            img2.image(v,clamp=True,use_column_width=True)
+            renderer.configure(colormap=session.colormap,rotate=session.rotate,sharp=session.sharp,scale=session.scale,
+                               annotations=session.annotations,encoding=session.encoding,autoscale=session.autoscale,
+                               tmin=session.tmin,tmax=session.tmax,contrast=session.contrast,brightness=session.brightness,
+                               fps=sch.fps,threshold=session.threshold) # no rendering of frames that are not shown or unchanged
+            res = renderer.latest()
+            if res is not None and res.seq != shown : # a new image was rendered
+                shown = res.seq
+                changed = True
+                if session.showscale and sch.due('colorbar') :
+                    with sch.stage('colorbar'),prof.stage('colorbar'):
+                        cb = cbar.render(session.colormap,res.lo,res.hi)
+                        if cb is not last_cbar : # send it only if it changed
+                            show_image(img_cbar,encode_png(cb),style='width:100%') # as wide as its column
+                            last_cbar = cb
+                im = res.image # encoded image bytes
+                with prof.stage('push image'):
+                    show_image(img,im,'image/jpeg' if session.encoding == 'jpeg' else 'image/png')
+                      
+        if session.showvideo and changed :
+            v = rotate(fr.video,session.rotate)        
+            with prof.stage('push video'):
+                show_image(img2,encode_png(v))
 
-    time.sleep(session.wait_delay/1000.)
+        if sch.due('load') :
+            session.load = f'{sch.fps:.1f} fps, cpu {sch.cpu*100:.0f}%, chart every {sch.tasks["chart"].current:.1f}s'
+        if prof.enabled and sch.due('profile') :
+            snap = prof.snapshot()
+            with profile_panel.container():
+                st.dataframe(prof.table(),hide_index=True)
+                st.caption(', '.join(f'{k} {v}' for k,v in {**snap['counters'],**snap['gauges']}.items()))
+            if session.profile_file :
+                prof.write(session.profile_file)
+        prof.frame()
+        sch.end_frame() # sleeps the slack until the next frame
 
-    if tm.check('restart') : # memory leak in streamlit
-        st.rerun()
-            
+        if mem.running and sch.due('memory') :
+            mem.sample()
+            memory_panel.code(mem.text())
+finally:
+    if renderer is not None : renderer.stop() # also on rerun and when the session ends
@@ -4,6 +4,8 @@ import io
 import plotly.express as px
 from datetime import datetime
 from extras import preserve_sessionstate,np_to_csv_stream,c_to_f
+from p2pro import raw_to_temperature
+from export import raw_bytes,to_npy
 
 st.set_page_config('Infiray P2Pro viewer',initial_sidebar_state="expanded",page_icon='🌡',layout='wide')
 session = st.session_state
@@ -32,12 +34,21 @@ if rotation == 270 :
 
 if fahrenheit :
     title = 'Temperature in Fahrenheit from raw data'
-    im = c_to_f(im)
+    if 'last_raw' in session : # direct lookup, no rounding of the Celsius values
+        im = raw_to_temperature(np.rot90(session.last_raw,rotation//90),'F')
+    else :
+        im = c_to_f(im)
 else :
     title = 'Temperature in Celsius from raw data'
 
-csv = np_to_csv_stream(im) 
-st.download_button('download csv file',data=csv,file_name=f'{datetime.now():%Y-%m-%d_%H:%M:%S}_p2pro.csv')  
+name = f'{datetime.now():%Y-%m-%d_%H:%M:%S}_p2pro'
+c1,c2,c3 = st.columns(3)
+c1.download_button('download csv file',data=np_to_csv_stream(im),file_name=f'{name}.csv')  
+if 'last_raw' in session :
+    raw = np.rot90(session.last_raw,rotation//90)
+    c2.download_button(f'download raw 16bit file ({raw.shape[1]}x{raw.shape[0]})',data=raw_bytes(raw),file_name=f'{name}.raw',
+                       help='little endian uint16, temperature in C = raw/64 - 273.2')
+    c3.download_button('download npy file',data=to_npy(np.ascontiguousarray(raw)),file_name=f'{name}_raw.npy')
 
 if autoscale :
     fig = px.imshow(im,aspect='equal',color_continuous_scale=colorscale,title=title) 
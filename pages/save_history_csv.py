@@ -1,4 +1,6 @@
 import streamlit as st
+import os
+import tempfile
 from history import history
 from datetime import datetime
 from extras import preserve_sessionstate
@@ -6,6 +8,16 @@ from extras import preserve_sessionstate
 session = st.session_state
 preserve_sessionstate(session)
 
-st.write('## save the full history as a csv file')
-csv = session.history.csv()
-st.download_button('download csv file',data=csv,file_name=f'{datetime.now():%Y-%m-%d_%H:%M:%S}_history.csv')  
+st.write('## save the full history')
+fmt = st.radio('file format',('csv','npz','npy'),horizontal=True,
+               help='npz: compressed float64 time t and float32 data, npy: one float64 array with the time in column 0')
+if st.button(f'prepare {fmt} file',help='the history is written block by block to a temporary file, not built in memory') :
+    if session.get('export_file') and os.path.exists(session.export_file) :
+        os.remove(session.export_file) # one per session
+    with tempfile.NamedTemporaryFile(suffix=f'.{fmt}',delete=False) as f :
+        session.history.save(f,fmt)
+    session.export_file = f.name
+    session.export_name = f'{datetime.now():%Y-%m-%d_%H:%M:%S}_history.{fmt}'
+if session.get('export_file') and os.path.exists(session.export_file) :
+    with open(session.export_file,'rb') as f :
+        st.download_button(f'download {session.export_name}',data=f,file_name=session.export_name)
@@ -0,0 +1,290 @@
+import numpy as np
+import cv2
+import time
+import threading
+import collections
+from colormap import colormapper
+from annotate import draw_annotation
+from extras import rotate_point
+from profiler import prof
+
+'''
+display pipeline: rotate -> blur/sharpen -> upscale -> normalize + colormap -> annotate -> encode.
+Every stage writes into buffers that are allocated once per frame geometry, the settings
+can be changed between frames with configure() without rebuilding anything.
+'''
+
+ROTATE_CODES = {90:cv2.ROTATE_90_COUNTERCLOCKWISE,180:cv2.ROTATE_180,270:cv2.ROTATE_90_CLOCKWISE} # same as np.rot90
+SHARPEN_KERNEL = np.array([[0, -1, 0], [-1, 5, -1], [0, -1, 0]],dtype=np.float32)
+ENCODINGS = ('none','png','jpeg')
+
+
+class pipeline:
+
+    def __init__(self,colormap='jet',rotate=0,sharp=0,scale=1,annotations=False,encoding='none',quality=90) -> None:
+        '''<sharp> < 0 blurs with a (1-sharp) box, >= 1 sharpens. <scale> is an integer upscaling factor
+           (bicubic on the temperatures). <encoding> 'none' returns the RGB image,
+           'png' or 'jpeg' the encoded bytes. The returned image is reused by the next call!'''
+        self.cmapper = colormapper(colormap)
+        self.shape = None
+        self.configure(rotate=rotate,sharp=sharp,scale=scale,annotations=annotations,encoding=encoding,quality=quality)
+
+    def configure(self,colormap=None,rotate=None,sharp=None,scale=None,annotations=None,encoding=None,quality=None):
+        'change settings, None keeps the current value'
+        if colormap is not None and colormap != self.cmapper.name : self.cmapper.set_colormap(colormap)
+        if rotate is not None :
+            assert rotate in (0,90,180,270), f'rotation must be 0,90,180 or 270, got {rotate}'
+            self.rotate = rotate
+        if sharp is not None : self.sharp = sharp
+        if scale is not None :
+            assert scale >= 1, f'scale must be >= 1, got {scale}'
+            self.scale = int(scale)
+        if annotations is not None : self.annotations = annotations
+        if encoding is not None :
+            assert encoding in ENCODINGS, f'encoding must be one of {ENCODINGS}, got {encoding}'
+            self.encoding = encoding
+        if quality is not None : self.quality = quality
+
+    def _buffers(self,shape):
+        if self.shape != shape :
+            self.shape = shape
+            h,w = shape
+            self.rot = {0:None,180:np.empty((h,w),np.float32),90:np.empty((w,h),np.float32),270:np.empty((w,h),np.float32)}
+            self.filt = {s:np.empty(s,np.float32) for s in ((h,w),(w,h))}
+            self.big = {}
+            self.bgr = {}
+
+    def rotated(self,temp):
+        if self.rotate == 0 : return temp
+        return cv2.rotate(temp,ROTATE_CODES[self.rotate],dst=self.rot[self.rotate])
+
+    def filtered(self,temp):
+        if self.sharp < 0 :
+            k = -self.sharp+1
+            return cv2.blur(temp,(k,k),dst=self.filt[temp.shape])
+        if self.sharp >= 1 :
+            return cv2.filter2D(temp,-1,SHARPEN_KERNEL,dst=self.filt[temp.shape])
+        return temp
+
+    def scaled(self,temp):
+        if self.scale == 1 : return temp
+        h,w = temp.shape
+        s = (h*self.scale,w*self.scale)
+        if s not in self.big : self.big[s] = np.empty(s,np.float32)
+        return cv2.resize(temp,(s[1],s[0]),dst=self.big[s],interpolation=cv2.INTER_CUBIC)
+
+    def annotate(self,rgb,stat,shape):
+        'min,max and center cursors, <stat> is frame_stats of the unrotated image of <shape>'
+        def pos(p): # sensor pixel to the center of the scaled display pixel
+            x,y = rotate_point(p,self.rotate,shape)
+            return (x*self.scale + self.scale//2,y*self.scale + self.scale//2)
+        draw_annotation(rgb,pos(stat.argmax),f'{stat.max:1.2f}C')
+        draw_annotation(rgb,pos(stat.argmin),f'{stat.min:1.2f}C',color='lightblue')
+        draw_annotation(rgb,pos((shape[1]//2,shape[0]//2)),f'{stat.center:1.2f}C',color='lightblue')
+
+    def encode(self,rgb):
+        if self.encoding == 'none' : return rgb
+        s = rgb.shape
+        if s not in self.bgr : self.bgr[s] = np.empty(s,np.uint8)
+        bgr = cv2.cvtColor(rgb,cv2.COLOR_RGB2BGR,dst=self.bgr[s])
+        if self.encoding == 'jpeg' :
+            ok,buf = cv2.imencode('.jpg',bgr,(cv2.IMWRITE_JPEG_QUALITY,self.quality))
+        else :
+            ok,buf = cv2.imencode('.png',bgr,(cv2.IMWRITE_PNG_COMPRESSION,1))
+        return buf.tobytes()
+
+    def __call__(self,temp,vmin,vmax,stat=None):
+        '''the display image of the temperature image <temp> with <vmin>..<vmax> mapped to the color table.
+           The cursors are drawn if annotations are on and the frame_stats <stat> of temp are given'''
+        self._buffers(temp.shape)
+        with prof.stage('rotate'):
+            img = self.rotated(temp)
+        with prof.stage('filter'):
+            img = self.scaled(self.filtered(img))
+        with prof.stage('colormap'):
+            rgb = self.cmapper.apply(img,vmin,vmax)
+        if self.annotations and stat is not None :
+            with prof.stage('annotate'):
+                self.annotate(rgb,stat,temp.shape)
+        with prof.stage('encode'):
+            return self.encode(rgb)
+
+
+def display_range(stat,autoscale=True,tmin=20.,tmax=60.,contrast=1.,brightness=0.):
+    '''(lo,hi) of the color scale and (vmin,vmax) of the color table. <contrast> and <brightness>
+       stretch and shift the range of the color table'''
+    lo,hi = (stat.min,stat.max) if autoscale else (tmin,tmax)
+    span = (hi-lo)/contrast
+    vmin = lo - brightness*span
+    return lo,hi,vmin,vmin+span
+
+
+class dropqueue:
+
+    def __init__(self,maxlen=2) -> None:
+        'bounded queue that drops the oldest item when it is full, the producer never blocks'
+        self.items = collections.deque(maxlen=maxlen)
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self,item):
+        with self.cond:
+            if len(self.items) == self.items.maxlen : self.dropped += 1
+            self.items.append(item)
+            self.cond.notify()
+
+    def get(self,timeout=None):
+        'the oldest item, None on timeout or if closed'
+        with self.cond:
+            self.cond.wait_for(lambda : self.items or self.closed,timeout)
+            return self.items.popleft() if self.items and not self.closed else None
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class changedetector:
+
+    def __init__(self,threshold=6.4,block=8) -> None:
+        '''tells if a raw frame differs visibly from the last changed one: the <block> x <block> means of the frames
+           are compared, which averages out the sensor noise, against <threshold> in raw units (64 per degree).
+           Slow drifts add up until they are reported. A threshold of 0 reports every frame'''
+        self.threshold = threshold
+        self.block = block
+        self.ref = None
+
+    def reset(self):
+        self.ref = None
+
+    def __call__(self,raw)->bool:
+        if self.threshold <= 0 : return True
+        h,w = raw.shape
+        size = (w//self.block,h//self.block)
+        if self.ref is None or self.ref.shape != size[::-1] :
+            self.ref = cv2.resize(raw,size,interpolation=cv2.INTER_AREA)
+            self.small = np.empty_like(self.ref)
+            self.diff = np.empty_like(self.ref)
+            return True
+        cv2.resize(raw,size,dst=self.small,interpolation=cv2.INTER_AREA)
+        cv2.absdiff(self.small,self.ref,dst=self.diff)
+        if cv2.minMaxLoc(self.diff)[1] <= self.threshold : return False
+        self.ref,self.small = self.small,self.ref
+        return True
+
+
+RENDER_KEYS = ('colormap','rotate','sharp','scale','annotations','encoding','quality','autoscale','tmin','tmax','contrast','brightness')
+
+rendered = collections.namedtuple('rendered','seq frame image lo hi')
+rendered.__doc__ = 'a finished display image of the hub frame <frame> with the color scale range lo,hi'
+
+
+class executor:
+
+    def __init__(self,hub,workers=2,queue=2,**settings) -> None:
+        '''renders the frames of the <hub> in parallel: a feeder thread takes every new frame from the hub
+           and queues it (dropping the oldest if all <workers> are busy), each worker thread has its own
+           pipeline. The OpenCV and numpy work releases the GIL, so consecutive frames are rendered on
+           different cores. Only the newest finished image is kept, late ones are discarded.
+           Frames without a visible change (see changedetector) are not rendered unless the settings changed.
+           <settings> are the pipeline and display_range settings, see configure()'''
+        self.hub = hub
+        self.queue = dropqueue(queue)
+        self.detector = changedetector()
+        self.skipped = 0 # unchanged frames
+        self.version = 0 # of the render settings
+        self.cpu = [0.]*(workers+1) # cpu time of the feeder and of each worker thread, updated per frame
+        self.settings = dict(encoding='jpeg')
+        self.configure(**settings)
+        self.result = None
+        self.cond = threading.Condition()
+        self.late = 0 # finished after a newer frame
+        self.running = False
+        self.threads = [threading.Thread(target=self._feed,name='render-feed',daemon=True)]
+        self.threads += [threading.Thread(target=self._work,args=(k+1,),name=f'render-{k}',daemon=True) for k in range(workers)]
+
+    def configure(self,**settings):
+        '''pipeline settings (colormap,rotate,sharp,scale,annotations,encoding,quality), display_range settings,
+           fps, the maximum rate of rendered frames and threshold, the visible change of a frame in C.
+           Only a change of a render setting renders the next frame even if it did not change'''
+        new = {**self.settings,**settings}
+        if new != self.settings :
+            if any(new.get(k) != self.settings.get(k) for k in RENDER_KEYS) : self.version += 1
+            self.settings = new # replaced, the workers read a consistent dict
+
+    @property
+    def cpu_time(self):
+        'cpu time in s used by the threads of the executor'
+        return sum(self.cpu)
+
+    def start(self):
+        self.running = True
+        for t in self.threads : t.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.queue.close()
+        with self.cond:
+            self.cond.notify_all()
+        for t in self.threads :
+            if t.is_alive() : t.join(1.)
+
+    def _feed(self):
+        seq = -1
+        tnext = 0.
+        version = None # of the settings of the last rendered frame
+        while self.running:
+            fr = self.hub.wait(seq,0.5)
+            if fr is None : continue
+            self.cpu[0] = time.thread_time() # cumulative, of the previous frames
+            seq = fr.seq
+            s = self.settings
+            if s.get('fps') : # limit to the display rate
+                if fr.t < tnext : continue
+                tnext = max(tnext + 1/s['fps'],fr.t)
+            self.detector.threshold = s.get('threshold',0.1) * 64
+            with prof.stage('change detection'):
+                changed = self.detector(fr.raw)
+            if not changed and version == self.version :
+                self.skipped += 1
+                prof.count('unchanged')
+                continue
+            version = self.version
+            self.queue.put(fr)
+            prof.gauge('render queue',len(self.queue.items))
+            prof.gauge('render queue dropped',self.queue.dropped)
+
+    def _work(self,k):
+        pipe = pipeline()
+        keys = ('colormap','rotate','sharp','scale','annotations','encoding','quality')
+        while self.running:
+            self.cpu[k] = time.thread_time()
+            fr = self.queue.get(0.5)
+            if fr is None : continue
+            s = self.settings
+            pipe.configure(**{k:s[k] for k in keys if k in s})
+            lo,hi,vmin,vmax = display_range(fr.stats,**{k:s[k] for k in ('autoscale','tmin','tmax','contrast','brightness') if k in s})
+            image = pipe(fr.temp,vmin,vmax,fr.stats)
+            if pipe.encoding == 'none' : image = image.copy() # the pipeline reuses its buffer
+            prof.count('rendered')
+            with self.cond:
+                if self.result is not None and self.result.seq > fr.seq :
+                    self.late += 1
+                    prof.count('rendered late')
+                    continue
+                self.result = rendered(fr.seq,fr,image,lo,hi)
+                self.cond.notify_all()
+
+    def latest(self)->rendered:
+        'the newest finished image without waiting, None if there is none'
+        with self.cond:
+            return self.result
+
+    def wait(self,seq,timeout=None)->rendered:
+        'the newest finished image if it is newer than <seq>, waits for it if needed. None on timeout'
+        with self.cond:
+            self.cond.wait_for(lambda : (self.result is not None and self.result.seq > seq) or not self.running,timeout)
+            return self.result if self.result is not None and self.result.seq > seq else None
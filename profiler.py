@@ -0,0 +1,199 @@
+import sys
+import os
+import json
+import time
+import threading
+import collections
+import numpy as np
+
+'''
+hot path instrumentation: stage timers with rolling histograms, counters and gauges, plus a
+sampling profiler for a number of frames. When disabled a stage is a shared no-op context,
+the cost is one attribute check per stage.
+
+from profiler import prof
+with prof.stage('colormap'): ...
+prof.count('frames')
+prof.gauge('queue',len(q))
+'''
+
+BINS = np.geomspace(1e-5,10,37) # 10 us .. 10 s, 6 bins per decade
+IDLE = ('(threading.py','(selectors.py','(socketserver.py','(queue.py') # samples of blocked threads are dropped
+
+
+class _null:
+    'no-op context of a disabled profiler'
+    def __enter__(self): return self
+    def __exit__(self,*exc): return False
+
+NULL = _null()
+
+
+class _span:
+
+    def __init__(self,prof,name) -> None:
+        self.prof = prof
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self,*exc):
+        self.prof.add(self.name,time.perf_counter() - self.t0)
+        return False
+
+
+class _rolling:
+
+    def __init__(self,size) -> None:
+        'the last <size> durations of a stage'
+        self.values = np.zeros(size)
+        self.n = 0 # total number of values
+
+    def add(self,dt):
+        self.values[self.n % len(self.values)] = dt
+        self.n += 1
+
+    def summary(self):
+        v = self.values[:min(self.n,len(self.values))]
+        p50,p95,p99 = np.percentile(v,(50,95,99)) * 1000
+        return dict(count=self.n,mean_ms=float(v.mean()*1000),p50_ms=float(p50),p95_ms=float(p95),p99_ms=float(p99),
+                    max_ms=float(v.max()*1000),hist=np.histogram(v,BINS)[0].tolist())
+
+
+class profiler:
+
+    def __init__(self,enabled=False,size=512) -> None:
+        '''collects the durations of the last <size> runs of each stage. The counters count up,
+           the gauges keep the last value'''
+        self.enabled = enabled
+        self.size = size
+        self.lock = threading.Lock()
+        self.reset()
+        self.sampler = None
+        self.report = None # text of the last sampling profile
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = collections.Counter()
+            self.gauges = {}
+            self.t0 = time.time()
+
+    def stage(self,name):
+        'context that times the block as stage <name>'
+        return _span(self,name) if self.enabled else NULL
+
+    def add(self,name,dt):
+        with self.lock:
+            s = self.stages.get(name)
+            if s is None : s = self.stages[name] = _rolling(self.size)
+            s.add(dt)
+
+    def count(self,name,n=1):
+        if self.enabled : self.counters[name] += n
+
+    def gauge(self,name,value):
+        if self.enabled : self.gauges[name] = value
+
+    def frame(self):
+        'marks the end of a display frame, also counts the frames of a running sampling profile'
+        if self.enabled : self.counters['frames'] += 1
+        if self.sampler is not None : self.sampler.frame()
+
+    def snapshot(self)->dict:
+        with self.lock:
+            stages = {name:s.summary() for name,s in self.stages.items()}
+            return dict(time=time.time(),seconds=time.time()-self.t0,stages=stages,
+                        counters=dict(self.counters),gauges=dict(self.gauges),bins_s=BINS.tolist())
+
+    def table(self):
+        'rows for a display of the stage timings, slowest (by total time) first'
+        snap = self.snapshot()
+        rows = [dict(stage=name,count=s['count'],mean_ms=round(s['mean_ms'],3),p50_ms=round(s['p50_ms'],3),
+                     p95_ms=round(s['p95_ms'],3),p99_ms=round(s['p99_ms'],3),max_ms=round(s['max_ms'],3))
+                for name,s in snap['stages'].items()]
+        return sorted(rows,key=lambda r : -r['mean_ms']*min(r['count'],self.size))
+
+    def write(self,path):
+        'the snapshot as json, replaced atomically'
+        tmp = path + '.tmp'
+        with open(tmp,'w') as f : json.dump(self.snapshot(),f)
+        os.replace(tmp,path)
+
+    def start_sampling(self,frames=100,interval=0.005,path=None):
+        'samples the stacks of all threads every <interval> s for the next <frames> frames, see sampler'
+        if self.sampler is not None : self.sampler.stop()
+        self.sampler = sampler(frames,interval,path,done=self._sampled)
+        self.sampler.start()
+
+    def _sampled(self,s):
+        self.report = s.text()
+        self.sampler = None
+
+    @property
+    def sampling(self):
+        return self.sampler is not None
+
+
+class sampler:
+
+    def __init__(self,frames=100,interval=0.005,path=None,done=None) -> None:
+        '''statistical profiler: a thread reads the stacks of all other threads (sys._current_frames)
+           every <interval> s until <frames> frames are counted with frame(). Threads waiting in threading
+           or selectors are not counted. The stacks are written to
+           <path> in the collapsed format of flamegraph tools (one 'a;b;c count' line per stack)'''
+        self.frames = frames
+        self.interval = interval
+        self.path = path
+        self.done = done
+        self.stacks = collections.Counter()
+        self.functions = collections.Counter() # self time
+        self.samples = 0
+        self.nframes = 0
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run,name='sampler',daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def frame(self):
+        self.nframes += 1
+        if self.nframes >= self.frames : self.running = False
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while self.running:
+            for t in threading.enumerate() : names[t.ident] = t.name
+            for ident,f in sys._current_frames().items():
+                if ident == me : continue
+                stack = []
+                while f is not None :
+                    stack.append(f'{f.f_code.co_name} ({os.path.basename(f.f_code.co_filename)}:{f.f_lineno})')
+                    f = f.f_back
+                if not stack or stack[0].split(':')[0].endswith(IDLE) : continue # blocked, not working
+                self.functions[stack[0].rsplit(':',1)[0] + ')'] += 1
+                stack.append(names.get(ident,str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        if self.path :
+            with open(self.path,'w') as f :
+                for stack,n in self.stacks.most_common() : f.write(f'{stack} {n}\n')
+        if self.done is not None : self.done(self)
+
+    def text(self,top=25):
+        'the functions with the most samples on top of the stack (wall clock, sleeping counts)'
+        total = sum(self.functions.values()) or 1
+        lines = [f'{self.samples} samples over {self.nframes} frames' + (f', stacks in {self.path}' if self.path else '')]
+        lines += [f'{n*100/total:5.1f}%  {name}' for name,n in self.functions.most_common(top)]
+        return '\n'.join(lines)
+
+
+prof = profiler() # the instrumentation of the app, disabled by default
@@ -0,0 +1,160 @@
+import os
+import time
+import zlib
+import base64
+import functools
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+import numpy as np
+import streamlit.components.v1 as components
+from colormap import colormap_lut,cmaplist
+from pipeline import changedetector
+
+'''
+display mode that ships the raw 16bit frames to the browser: the colormapping, rotation,
+scaling and the cursors are done there by the component in components/rawview (plain javascript,
+needs a browser with DecompressionStream). The server only compresses the raw data,
+the colormap, range and cursor settings of its toolbar work without a round trip.
+
+The component is created once per script run with a fixed key, a component call per frame would
+register a new widget each time in the never ending display loop. The frames take another way:
+rawfeed serves the newest visibly changed frame on http://<host>:<port>/frame (long polling),
+the component fetches them from the host of the page. Only that page may read them: other origins
+get no CORS header (a browser then hides the response from their scripts) and a 403.
+'''
+
+_component = components.declare_component('rawview',path=os.path.join(os.path.dirname(os.path.abspath(__file__)),'components','rawview'))
+
+
+@functools.lru_cache(maxsize=None)
+def palette(name):
+    'base64 of the 256 RGB entries of the colormap <name>'
+    return base64.b64encode(colormap_lut(name)[:,0].tobytes()).decode()
+
+
+class rawfeed:
+
+    def __init__(self,port,host='127.0.0.1',page_port=8501,level=1,idle=5.) -> None:
+        '''one per process, shared by the sessions: a thread takes the frames of <hub>, skips those without
+           a visible change (see pipeline.changedetector) and compresses the others: the rows are delta coded
+           (difference to the left neighbour) before the zlib compression with <level>. Nothing is done when
+           no browser asked for a frame in the last <idle> seconds.
+           Listens on <host>, only pages served from <page_port> of the requested host name may read the frames'''
+        self.port = port
+        self.host = host
+        self.page_port = page_port
+        self.level = level
+        self.idle = idle
+        self.hub = None # set by the app, may be replaced after a restart
+        self.detector = changedetector()
+        self.cond = threading.Condition()
+        self.frame = None # (number,shape,compressed bytes) of the newest frame
+        self.count = 0 # frames published
+        self.trequest = 0.
+        self.delta = None
+        self.size = 0 # compressed bytes of the last frame
+        self.running = False
+
+    def encode(self,raw):
+        'zlib compressed, delta coded uint16 image'
+        if self.delta is None or self.delta.shape != raw.shape :
+            self.delta = np.empty(raw.shape,dtype='<u2')
+        self.delta[:,0] = raw[:,0]
+        np.subtract(raw[:,1:],raw[:,:-1],out=self.delta[:,1:]) # wraps around mod 2**16, undone in the browser
+        z = zlib.compress(self.delta,self.level)
+        self.size = len(z)
+        return z
+
+    def allowed(self,origin,host):
+        'True if the page <origin> is the streamlit page on the host name <host> the browser asked for'
+        if origin is None : return True # no browser request from a page, no foreign script can read it
+        try:
+            page = urllib.parse.urlsplit(origin)
+            return page.port == self.page_port and page.hostname == urllib.parse.urlsplit('//' + host).hostname
+        except ValueError:
+            return False
+
+    def start(self):
+        'raises OSError if the port is in use'
+        feed = self
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                if url.path != '/frame' :
+                    self.send_error(404)
+                    return
+                origin = self.headers.get('Origin')
+                if not feed.allowed(origin,self.headers.get('Host','')) :
+                    self.send_error(403)
+                    return
+                try:
+                    after = int(urllib.parse.parse_qs(url.query).get('after',['-1'])[0])
+                except ValueError:
+                    after = -1
+                fr = feed.get(after)
+                self.send_response(200 if fr is not None else 204)
+                if origin is not None : # the page comes from the streamlit port
+                    self.send_header('Access-Control-Allow-Origin',origin)
+                    self.send_header('Vary','Origin')
+                    self.send_header('Access-Control-Expose-Headers','X-Frame,X-Shape')
+                self.send_header('Cache-Control','no-store')
+                if fr is None :
+                    self.end_headers()
+                    return
+                n,shape,data = fr
+                self.send_header('Content-Type','application/octet-stream')
+                self.send_header('Content-Length',str(len(data)))
+                self.send_header('X-Frame',str(n))
+                self.send_header('X-Shape',f'{shape[0]},{shape[1]}')
+                self.end_headers()
+                self.wfile.write(data)
+            def log_message(self,*args): # no access log
+                pass
+        self.server = ThreadingHTTPServer((self.host,self.port),handler)
+        self.server.daemon_threads = True
+        self.running = True
+        threading.Thread(target=self.server.serve_forever,name='rawfeed-http',daemon=True).start()
+        threading.Thread(target=self._run,name='rawfeed',daemon=True).start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self,after,timeout=10.):
+        'the newest frame if its number is above <after>, waits up to <timeout> s for it. None on timeout'
+        with self.cond:
+            self.trequest = time.time()
+            if after > self.count : after = -1 # the numbers started again (restart of the app)
+            self.cond.wait_for(lambda : self.frame is not None and self.frame[0] > after,timeout)
+            return self.frame if self.frame is not None and self.frame[0] > after else None
+
+    def _run(self):
+        seq,hb = -1,None
+        while self.running:
+            if self.hub is not hb : # new hub after a restart, its sequence numbers start again
+                seq,hb = -1,self.hub
+                self.detector.reset()
+            if hb is None or time.time() - self.trequest > self.idle :
+                time.sleep(0.1)
+                continue
+            fr = hb.wait(seq,1.)
+            if fr is None :
+                if not hb.running : time.sleep(0.1)
+                continue
+            seq = fr.seq
+            if not self.detector(fr.raw) : continue
+            data = self.encode(fr.raw)
+            with self.cond:
+                self.count += 1
+                self.frame = (self.count,fr.raw.shape,data)
+                self.cond.notify_all()
+
+
+def rawview(port,colormap='jet',rotate=0,autoscale=True,tmin=20.,tmax=60.,annotations=False,width=0,key='rawview'):
+    '''shows the frames of the rawfeed on <port>, call it once per script run. The settings are the initial
+       values of the browser toolbar, a change here overrides the local setting of the browser'''
+    _component(port=port,colormap=colormap,rotate=rotate,autoscale=autoscale,tmin=float(tmin),tmax=float(tmax),
+               annotations=annotations,width=width,palettes={name:palette(name) for name in cmaplist},key=key,default=None)
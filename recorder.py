@@ -0,0 +1,205 @@
+import numpy as np
+import struct
+import threading
+import queue
+import zlib
+import time
+
+'''
+Recording of the raw 16bit frame stream into a chunked file:
+
+file header  : magic, image height, image width
+chunk        : chunk header (magic, frames, compressed size, first and last time),
+               float64 time stamps, zlib compressed frames (high and low bytes in separate planes)
+index        : written by close(), one entry (file offset, first frame, frames, first and last time) per chunk
+trailer      : offset of the index, magic
+
+A file without index (e.g. after a crash) is read by scanning the chunk headers.
+'''
+
+FILE_HDR = struct.Struct('<8sII')
+CHUNK_HDR = struct.Struct('<4sIIdd')
+INDEX_HDR = struct.Struct('<4sI')
+TRAILER = struct.Struct('<Q8s')
+FILE_MAGIC = b'P2PRAW01'
+CHUNK_MAGIC = b'CHNK'
+INDEX_MAGIC = b'INDX'
+TRAILER_MAGIC = b'P2PRIDX1'
+INDEX = np.dtype([('offset','<u8'),('first','<u8'),('n','<u4'),('t0','<f8'),('t1','<f8')])
+
+
+def _shuffle(frames):
+    'high and low bytes in two planes, compresses much better than interleaved words'
+    return frames.view(np.uint8).reshape(-1,2).T.tobytes()
+
+def _unshuffle(data,shape):
+    planes = np.frombuffer(data,dtype=np.uint8).reshape(2,-1)
+    out = np.empty(shape,dtype='<u2')
+    out.view(np.uint8).reshape(-1,2)[:] = planes.T
+    return out
+
+
+class recorder:
+
+    def __init__(self,path,shape=(192,256),chunk_frames=50,level=1,buffers=8) -> None:
+        '''writes raw 16bit frames with time stamps to <path>. add() only copies the frame into a
+           preallocated chunk buffer, compression and writing run in a background thread.
+           If all <buffers> chunk buffers wait for the writer, new frames are dropped and counted.
+           add() may run in another thread than close(), frames added after close() are ignored'''
+        self.path = path
+        self.shape = tuple(shape)
+        self.chunk_frames = chunk_frames
+        self.level = level
+        self.f = open(path,'wb')
+        self.f.write(FILE_HDR.pack(FILE_MAGIC,*self.shape))
+        self.index = []
+        self.frames = 0 # frames accepted
+        self.dropped = 0
+        self.free = queue.Queue()
+        for _ in range(buffers):
+            self.free.put((np.empty(chunk_frames,dtype=np.float64),np.empty((chunk_frames,)+self.shape,dtype='<u2')))
+        self.full = queue.Queue()
+        self.current = None
+        self.n = 0 # frames in the current chunk buffer
+        self.lock = threading.Lock() # guards current and n against a concurrent close
+        self.closed = False
+        self.thread = threading.Thread(target=self._writer,name='p2pro-recorder',daemon=True)
+        self.thread.start()
+
+    def add(self,raw,t=None):
+        'queue one raw frame, never waits for the writer'
+        with self.lock:
+            if self.closed : return
+            if self.current is None :
+                try:
+                    self.current = self.free.get_nowait()
+                except queue.Empty:
+                    self.dropped += 1
+                    return
+            times,frames = self.current
+            times[self.n] = time.time() if t is None else t
+            frames[self.n] = raw
+            self.n += 1
+            self.frames += 1
+            if self.n == self.chunk_frames :
+                self._submit()
+
+    def _submit(self):
+        'hands the current buffer to the writer, called with the lock held'
+        if self.current is not None and self.n :
+            self.full.put((self.current,self.n))
+        self.current = None
+        self.n = 0
+
+    def _writer(self):
+        while True:
+            item = self.full.get()
+            if item is None : break
+            (times,frames),n = item
+            data = zlib.compress(_shuffle(frames[:n]),self.level) # zlib releases the GIL
+            offset = self.f.tell()
+            self.f.write(CHUNK_HDR.pack(CHUNK_MAGIC,n,len(data),times[0],times[n-1]))
+            self.f.write(times[:n].tobytes())
+            self.f.write(data)
+            first = self.index[-1][1] + self.index[-1][2] if self.index else 0
+            self.index.append((offset,first,n,times[0],times[n-1]))
+            self.free.put((times,frames))
+
+    def close(self):
+        'write the remaining frames and the index'
+        with self.lock:
+            if self.closed : return
+            self.closed = True
+            self._submit()
+        self.full.put(None) # after the last chunk, add() can not queue another one
+        self.thread.join()
+        offset = self.f.tell()
+        self.f.write(INDEX_HDR.pack(INDEX_MAGIC,len(self.index)))
+        self.f.write(np.array(self.index,dtype=INDEX).tobytes())
+        self.f.write(TRAILER.pack(offset,TRAILER_MAGIC))
+        self.f.close()
+        self.f = None
+
+    def __del__(self):
+        if not getattr(self,'closed',True) : self.close() # not if __init__ failed
+
+
+class recording:
+
+    def __init__(self,path) -> None:
+        'random access reader for files of the recorder, only the needed chunk is decompressed'
+        self.path = path
+        self.f = open(path,'rb')
+        magic,h,w = FILE_HDR.unpack(self.f.read(FILE_HDR.size))
+        if magic != FILE_MAGIC : raise ValueError(f'{path} is no p2pro raw recording')
+        self.shape = (h,w)
+        self.index = self._read_index()
+        self.cache = (-1,None,None) # chunk number, times, frames
+
+    def _read_index(self):
+        self.f.seek(0,2)
+        size = self.f.tell()
+        if size >= FILE_HDR.size + TRAILER.size :
+            self.f.seek(size - TRAILER.size)
+            offset,magic = TRAILER.unpack(self.f.read(TRAILER.size))
+            if magic == TRAILER_MAGIC :
+                self.f.seek(offset)
+                _,n = INDEX_HDR.unpack(self.f.read(INDEX_HDR.size))
+                return np.frombuffer(self.f.read(n*INDEX.itemsize),dtype=INDEX)
+        # no index, scan the chunk headers
+        index = []
+        offset = FILE_HDR.size
+        first = 0
+        while offset + CHUNK_HDR.size <= size :
+            self.f.seek(offset)
+            magic,n,csize,t0,t1 = CHUNK_HDR.unpack(self.f.read(CHUNK_HDR.size))
+            end = offset + CHUNK_HDR.size + 8*n + csize
+            if magic != CHUNK_MAGIC or end > size : break # incomplete last chunk
+            index.append((offset,first,n,t0,t1))
+            first += n
+            offset = end
+        return np.array(index,dtype=INDEX)
+
+    def __len__(self):
+        return int(self.index['first'][-1] + self.index['n'][-1]) if len(self.index) else 0
+
+    def duration(self):
+        return self.index['t1'][-1] - self.index['t0'][0] if len(self.index) else 0.
+
+    def _chunk(self,k):
+        if self.cache[0] != k :
+            offset,_,n,_,_ = self.index[k]
+            self.f.seek(int(offset))
+            _,n,csize,_,_ = CHUNK_HDR.unpack(self.f.read(CHUNK_HDR.size))
+            times = np.frombuffer(self.f.read(8*n),dtype=np.float64)
+            frames = _unshuffle(zlib.decompress(self.f.read(csize)),(n,)+self.shape)
+            self.cache = (k,times,frames)
+        return self.cache[1],self.cache[2]
+
+    def frame(self,n):
+        'returns (t,raw) of frame number <n>'
+        if not 0 <= n < len(self) : raise IndexError(f'frame {n} not in recording of {len(self)} frames')
+        k = np.searchsorted(self.index['first'],n,side='right') - 1
+        times,frames = self._chunk(k)
+        i = n - int(self.index['first'][k])
+        return times[i],frames[i]
+
+    def find(self,t):
+        'number of the last frame recorded at or before the time <t> (0 if <t> is before the start)'
+        k = max(np.searchsorted(self.index['t0'],t,side='right') - 1,0)
+        times,_ = self._chunk(k)
+        return int(self.index['first'][k]) + max(np.searchsorted(times,t,side='right') - 1,0)
+
+    def at(self,t):
+        'returns (n,t,raw) of the frame at the time <t>'
+        n = self.find(t)
+        return (n,)+tuple(self.frame(n))
+
+    def __iter__(self):
+        'all (t,raw) in recording order'
+        for k in range(len(self.index)):
+            times,frames = self._chunk(k)
+            yield from zip(times,frames)
+
+    def close(self):
+        self.f.close()
@@ -0,0 +1,129 @@
+import numpy as np
+import cv2
+import time
+from p2pro import p2pro,FRAME_SHAPE
+from recorder import recording
+
+'''
+camera sources without a camera: replay of raw recordings (see recorder.py) and synthetic scenes.
+Both have the interface of the p2pro class, open_camera() selects the source from the camera id string:
+
+file:<path>[,<rate>]   replay a recording
+synthetic:[<rate>]     generated moving hot spot scene
+anything else          a real P2Pro camera
+
+<rate> is 'realtime' (recorded time stamps, 25 fps for synthetic scenes), 'fast' (as fast as possible)
+or a number of frames per second.
+'''
+
+SENSOR_FPS = 25.
+
+
+def parse_rate(rate):
+    'realtime, fast or frames per second as float'
+    rate = str(rate).strip().lower()
+    if rate in ('','realtime') : return 'realtime'
+    if rate == 'fast' : return 'fast'
+    return float(rate)
+
+
+def open_camera(cam_id):
+    'returns a p2pro, replaycam or syntheticcam object for the camera id string <cam_id>'
+    cam_id = str(cam_id)
+    if cam_id.startswith('file:') :
+        path,_,rate = cam_id[5:].partition(',')
+        return replaycam(path,rate)
+    if cam_id.startswith('synthetic:') :
+        return syntheticcam(cam_id[10:])
+    return p2pro(cam_id)
+
+
+def make_frame(raw):
+    'builds a camera frame from a raw 16bit image: raw data in the lower half, normalized 8bit video in the upper'
+    frame = np.zeros(FRAME_SHAPE,dtype=np.uint8)
+    frame[1] = raw.astype('<u2',copy=False).view(np.uint8).reshape(FRAME_SHAPE[1:])
+    frame[0,:,:,0] = cv2.normalize(raw,None,0,255,cv2.NORM_MINMAX,cv2.CV_8U)
+    return frame
+
+
+class _pacer:
+
+    def __init__(self,rate) -> None:
+        'sleeps between frames according to <rate>, see parse_rate()'
+        self.rate = parse_rate(rate)
+        self.t0 = None # wall clock and frame time of the first frame
+        self.next = None
+
+    def wait(self,t=None):
+        'wait until the frame with the time stamp <t> is due'
+        now = time.perf_counter()
+        if self.rate == 'fast' : return
+        if self.rate == 'realtime' and t is not None :
+            if self.t0 is None or t < self.t0[1] : self.t0 = (now,t) # start or restart of a loop
+            delay = self.t0[0] + t - self.t0[1] - now
+        else :
+            fps = SENSOR_FPS if self.rate == 'realtime' else self.rate
+            if self.next is None or now - self.next > 1. : self.next = now # do not catch up after a stall
+            delay = self.next - now
+            self.next += 1/fps
+        if delay > 0 : time.sleep(delay)
+
+
+class replaycam(p2pro):
+
+    def __init__(self,path,rate='realtime',loop=True) -> None:
+        'replays the raw frames of a recording with the p2pro interface, starts over at the end if <loop>'
+        self._setup() # first, release() must work if the recording can not be opened
+        self.rec = None
+        self.rec = recording(path)
+        if len(self.rec) == 0 : raise IOError(f'{path} contains no frames')
+        self.pacer = _pacer(rate)
+        self.loop = loop
+        self.n = 0 # next frame number
+
+    def _read(self):
+        if self.n >= len(self.rec) :
+            if not self.loop : raise IOError('end of the recording')
+            self.n = 0
+        t,raw = self.rec.frame(self.n)
+        self.n += 1
+        self.pacer.wait(t)
+        return make_frame(raw)
+
+    def release(self):
+        self.stop()
+        if self.rec is not None : self.rec.close()
+
+
+class syntheticcam(p2pro):
+
+    def __init__(self,rate='realtime',background=22.,spot=65.,noise=0.1,seed=0) -> None:
+        '''generated scene with the p2pro interface: <background> temperature in C with a gradient,
+           a hot spot of <spot> C moving on a circle and gaussian sensor noise of <noise> C'''
+        self._setup()
+        self.pacer = _pacer(rate)
+        self.background = background
+        self.spot = spot
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        h,w = FRAME_SHAPE[1:3]
+        self.y,self.x = np.mgrid[0:h,0:w].astype(np.float32)
+        self.n = 0
+
+    def scene(self,n):
+        'temperature image in C of frame number <n>'
+        h,w = self.x.shape
+        a = n * 2*np.pi/250 # one turn in 10 s at 25 fps
+        cx,cy = w/2 + w/4*np.cos(a),h/2 + h/4*np.sin(a)
+        temp = self.background + 2*self.x/w + (self.spot-self.background) * np.exp(-((self.x-cx)**2 + (self.y-cy)**2)/200)
+        if self.noise : temp += self.rng.normal(0,self.noise,temp.shape).astype(np.float32)
+        return temp
+
+    def _read(self):
+        self.pacer.wait()
+        raw = np.clip((self.scene(self.n) + 273.2) * 64,0,65535).astype(np.uint16)
+        self.n += 1
+        return make_frame(raw)
+
+    def release(self):
+        self.stop()
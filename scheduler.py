@@ -0,0 +1,99 @@
+import time
+import contextlib
+
+'''
+frame rate control of the display loop. Instead of a fixed sleep the loop runs at a target
+frame rate, lowered automatically when the loop needs more cpu than the budget allows.
+Periodic tasks (chart, colorbar..) run on deadlines, their intervals grow when they are
+expensive or the loop is over budget.
+
+sch = scheduler(fps=10,cpu_budget=0.5)
+sch.task('chart',0.5,adaptive=True)
+while True:
+    sch.start_frame()
+    with sch.stage('render'): ...
+    if sch.due('chart'):
+        with sch.stage('chart'): ...
+    sch.end_frame() # sleeps the remaining slack
+'''
+
+
+class _task:
+
+    def __init__(self,interval,adaptive,max_interval) -> None:
+        self.interval = interval # requested
+        self.current = interval # effective
+        self.adaptive = adaptive
+        self.max_interval = max_interval
+        self.deadline = 0. # due immediately
+
+
+class scheduler:
+
+    def __init__(self,fps=10.,cpu_budget=1.,task_share=0.25,window=1.,clock=time.thread_time) -> None:
+        '''<fps> target display frame rate, <cpu_budget> cpu time per second (1 = one core) that the
+           frame rate control aims for. An adaptive task may use up to <task_share> of the loop time.
+           The cpu use is measured over <window> seconds with <clock>, by default the cpu time of the
+           thread of the loop; add the time of threads that work for the loop (e.g. render threads)
+           but not that of threads shared with other loops'''
+        self.target = fps
+        self.fps = fps # effective, <= target
+        self.cpu_budget = cpu_budget
+        self.task_share = task_share
+        self.window = window
+        self.clock = clock
+        self.tasks = {}
+        self.costs = {} # stage name -> smoothed duration in s
+        self.cpu = 0. # measured cpu use of the loop in cores
+        self.tframe = time.perf_counter()
+        self._t0 = (time.perf_counter(),clock())
+
+    def task(self,name,interval,adaptive=False,max_interval=None):
+        'a periodic task with the requested <interval> in s, an adaptive one is stretched up to <max_interval> under load'
+        self.tasks[name] = _task(interval,adaptive,max_interval or 20*interval)
+
+    def due(self,name)->bool:
+        'True if the task is due, the next deadline is one interval later'
+        t = self.tasks[name]
+        now = time.perf_counter()
+        if now < t.deadline : return False
+        t.deadline += t.current
+        if t.deadline <= now : t.deadline = now + t.current # fell behind, no burst of catch up runs
+        return True
+
+    @contextlib.contextmanager
+    def stage(self,name):
+        'measures the duration of the block as smoothed cost of <name>'
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            c = self.costs.get(name)
+            self.costs[name] = dt if c is None else 0.8*c + 0.2*dt
+
+    def start_frame(self):
+        self.tframe = time.perf_counter()
+
+    def end_frame(self):
+        'adapts the frame rate and the task intervals and sleeps until the next frame is due'
+        now = time.perf_counter()
+        t0,c0 = self._t0
+        if now - t0 >= self.window :
+            c = self.clock()
+            self.cpu = (c - c0)/(now - t0)
+            self._t0 = (now,c)
+            if self.cpu > self.cpu_budget : # proportional step down
+                self.fps = max(self.fps * max(self.cpu_budget/self.cpu,0.5),0.5)
+            else : # slow step up
+                self.fps = min(self.fps * 1.1 + 0.1,self.target)
+            self._adapt()
+        delay = self.tframe + 1/self.fps - time.perf_counter()
+        if delay > 0 : time.sleep(delay)
+
+    def _adapt(self):
+        load = self.target/self.fps # > 1 if we run below the target rate
+        for name,t in self.tasks.items():
+            if not t.adaptive : continue
+            cost = self.costs.get(name,0.)
+            t.current = min(max(t.interval*load,cost/self.task_share),max(t.max_interval,t.interval))